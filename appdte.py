@@ -5,7 +5,26 @@
 # Created Date:     13 December 2020
 # Purpose:          AppDynamics & Integration Script using both AppD and TE APIs
 # Prerequisites:    Compatible with python3 and python2, requires requests and pyyaml packages
+#                   (python2 additionally requires the futures package)
 # Change history:   0.3 - Parameter Logging, Additional Default fields Account Group and Hostname
+#                   0.4 - Concurrent per-test collection with per-host concurrency cap and global deadline
+#                   0.5 - Account group id cache with TTL, persisted under state/
+#                   0.6 - Pooled keep-alive sessions per upstream with timeouts and retry/backoff
+#                   0.7 - Batched publishing to the AppDynamics Events API
+#                   0.8 - Incremental collection with persisted roundId watermarks and gap backfill
+#                   0.9 - Daemon mode with internal scheduler, config hot reload and graceful shutdown
+#                   0.10 - Hash indexed join of metric families, bgp-metrics published per monitor
+#                   0.11 - Field projection plan compiled from the schema types with a memoized date parser
+#                   0.12 - Optional streaming parsing of metric responses (requires ijson)
+#                   0.13 - Request and phase instrumentation as Machine Agent custom metrics or Prometheus endpoint
+#                   0.14 - Schema created and patched through the Events API, skipped while its fingerprint is unchanged
+#                   0.15 - Test discovery from the ThousandEyes tests listing with type, name, label and enabled filters
+#                   0.16 - Interval aware scheduling, tests are polled when a new round is due and spread across the cycle
+#                   0.17 - Adaptive rate limiting of ThousandEyes requests following the quota headers, queued by test priority
+#                   0.18 - Events are spooled on disk and published in order by a background publisher, replayed after outages
+#                   0.19 - Several ThousandEyes account groups and AppDynamics destinations collected concurrently by one process
+#                   0.20 - Response cache deduplicating ThousandEyes requests per cycle, revalidated with ETags, remembering endpoints without data
+#                   0.21 - Compact event encoding (orjson when installed) and gzip compressed Events API requests
 #
 # THE SCRIPT IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
 # INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
@@ -15,6 +34,7 @@
 # ARISING FROM, OUT OF OR IN CONNECTION WITH THIS SCRIPT OR THE USE OR OTHER DEALINGS IN THE SCRIPT.
 # **********************************************************************
 import errno
+import hashlib
 import requests
 import json
 import getopt
@@ -22,12 +42,41 @@ import yaml
 from datetime import date
 import time
 import os
+from itertools import chain
+from collections import OrderedDict
 import logging
+import re
 import sys
+from email.utils import parsedate_tz, mktime_tz
+import threading
+import signal
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import TimeoutError as FuturesTimeoutError
 from requests.auth import HTTPBasicAuth
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+try:
+    from urllib.parse import urlparse, parse_qsl
+except ImportError:
+    from urlparse import urlparse, parse_qsl
+try:
+    import ijson
+except ImportError:
+    ijson = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
 
 if not os.path.exists('logs'):
     os.makedirs('logs')
+if not os.path.exists('state'):
+    os.makedirs('state')
 logging.basicConfig(filename='logs/appd_te.log', format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
 
 
@@ -40,7 +89,7 @@ full_cmd_arguments = sys.argv
 # Keep all but the first
 argument_list = full_cmd_arguments[1:]
 short_options = "hc:v"
-long_options = ["help", "config=","logPath=", "verbose"]
+long_options = ["help", "config=","logPath=", "verbose", "daemon"]
 try:
     arguments, values = getopt.getopt(argument_list, short_options, long_options)
 except getopt.error as err:
@@ -50,6 +99,7 @@ except getopt.error as err:
 
 log_filename='logs/appd_te.log'
 log_level=logging.INFO
+daemon_mode=False
 
 
 for current_argument, current_value in arguments:
@@ -79,222 +129,908 @@ for current_argument, current_value in arguments:
     elif current_argument in ("-c", "--config"):
         config_file=current_value
         logging.info("Config file location changed to "+config_file)
+    elif current_argument == "--daemon":
+        daemon_mode=True
+        logging.info("Running in daemon mode")
 
 
 
 logging.info("Started AppDynamics & Thousand Eyes Extension")
-test_fields = []
-metric_fields = []
-te_config = []
-appd_config = []
-testIds = []
-extension_schema={}
-# Create Client
-client = requests.session()
-
-def appdynamics_create_schema(schema):
-    logging.info("Creating Script for Analytics Schema Creation......")
-    command = "curl -X POST \"${events_service}:${port}/events/schema/$schemaName\" -H\"X-Events-API-AccountName:${accountName}\" -H\"X-Events-API-Key:${apiKey}\" -H\"Content-type: application/vnd.appd.events+json;v=2\" -d '{\"schema\":" + json.dumps(
-        schema) + "}'"
-    with open('createSchema.sh', 'w') as rsh:
-        rsh.write('''\
-    #!/bin/bash
-    schemaName=
-    accountName=
-    apiKey=
-    events_service=
-    port=
-
-    while test $# -gt 0; do
-        case $1 in
-          -h|--help)
-             echo "AppDynamics Analytics Schema Creation"
-             echo " "
-             echo "-------------------------------------"
-             echo " "
-             echo "options:"
-             echo "-h,  --help                show brief help"
-             echo "-sc, --schema              AppDynamics Schema Name specify an action to use"
-             echo "-ac, --accountname         AppDynamics Global Account Name"
-             echo "-k , --key                 AppDynamics Analytics API Key"
-             echo "-es                        AppDynamics events service host name, inc protocol Example: https://analytics.api.appdynamics.com"
-             echo "-port                      AppDynamics events service port"
-             exit 0
-         ;;
-            -sc | --schema )        shift
-                                    schemaName="$1"
-                                    ;;
-            -ac | --accountname )   shift
-                                    accountName="$1"
-                                    ;;
-            -k | --key )            shift
-                                    apiKey="$1"
-                                    ;;
-            -es)                    shift
-                                    events_service="$1"
-                                    ;;
-            -port)                  shift
-                                    port=$1
-                                    ;;
-            * )                     usage
-                                    exit 1
-         esac
-         shift
-     done
-    ''')
-        rsh.write(command)
-        rsh.close()
-        logging.info("Custom schema creation has been created. Please navigate to: "+os.getcwd())
-        logging.info("Change permissions to createSchema.sh chmod +x createSchema.sh")
-        logging.info("execute createSchema.sh in order to create the AppDynamics Analytics schema")
-        sys.exit()
+tenant_configs = []
+collection_config = {}
+transport_config = {}
+publishing_config = {}
+daemon_config = {}
+instrumentation_config = {}
+scheduling_config = {}
+response_cache_config = {}
+config_mtime = None
 
+def get_verification(tls_certificate):
+    if(tls_certificate):
+        logging.info("Certificate has been changed using configuration yaml")
+        logging.debug("New certificate path is "+ str(tls_certificate['certificateBundlePath']))
+        return tls_certificate['certificateBundlePath']
+    else:
+        logging.info("Certificate has not been set defaults to verification False")
+        return False
 
 
-try:
+date_cache = {}
+
+
+def convert_date(value):
+    # ThousandEyes dates are local time 'YYYY-MM-DD HH:MM:SS' strings and the same few values repeat for every agent of a round
+    epoch = date_cache.get(value)
+    if epoch is None:
+        epoch = int(time.mktime((int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                                 int(value[11:13]), int(value[14:16]), int(value[17:19]), 0, 0, -1)) * 1000)
+        if len(date_cache) > 10000:
+            date_cache.clear()
+        date_cache[value] = epoch
+    return epoch
+
+
+def convert_string(value):
+    if isinstance(value, list):
+        # apiLinks is a list of links, the first href is published
+        if value and isinstance(value[0], dict) and 'href' in value[0]:
+            return value[0]['href']
+        return json.dumps(value)
+    return value
+
+
+def convert_passthrough(value):
+    return value
+
+
+def encode_json(value):
+    # Events are serialized without whitespace, with orjson when it is installed and json for values orjson rejects
+    if orjson is not None:
+        try:
+            return orjson.dumps(value).decode('utf-8')
+        except TypeError:
+            pass
+    return json.dumps(value, separators=(',', ':'))
+
+
+def gzip_compress(data, level=6):
+    # zlib with a gzip header (wbits 31) instead of gzip.compress, which Python 2 does not have
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+field_converters = {
+    'date': convert_date,
+    'integer': int,
+    'float': float,
+    'string': convert_string
+}
+
+
+def compile_projection_plan(fields):
+    plan = []
+    for field, field_type in fields.items():
+        plan.append((field, field_converters.get(str(field_type).lower(), convert_passthrough)))
+    return tuple(plan)
+
+
+def project_fields(source, plan, target):
+    for field, converter in plan:
+        if field in source:
+            value = source[field]
+            try:
+                target[field] = converter(value)
+            except (TypeError, ValueError, KeyError, IndexError):
+                logging.debug("Skipping field " + field + " with unexpected value " + str(value))
+    return target
+
+
+tenant_sections = ('TEConfig', 'AppDynamics', 'Discovery', 'RateLimit', 'Extension', 'Test', 'Metrics')
+required_tenant_keys = {
+    'TEConfig': ('teAPI', 'teUsername', 'teKey', 'teAccountGroup'),
+    'AppDynamics': ('appdEventsService', 'analyticsApiKey', 'globalAccountName', 'schemaName')
+}
+
+
+def get_tenant_configs(data):
+    # Every entry under Tenants overrides the keys of the top level sections, without a Tenants list
+    # the top level sections are collected as the only tenant and keep their state directly under state/
+    tenant_entries = data['ThousandEyes'].get('Tenants') or []
+    new_tenant_configs = []
+    for entry in tenant_entries or [{'name': 'default'}]:
+        name = str(entry.get('name') or '')
+        if not name:
+            raise ValueError("Every entry under Tenants requires a name")
+        if name in [tenant_config['name'] for tenant_config in new_tenant_configs]:
+            raise ValueError("Tenant name " + name + " is used more than once")
+        tenant_config = {'name': name, 'stateDirectory': 'state'}
+        if tenant_entries:
+            # Names that only differ in replaced characters would share a state directory
+            directory_name = re.sub(r'[^A-Za-z0-9_.-]', '_', name)
+            if directory_name in ('.', '..'):
+                raise ValueError("Tenant name " + name + " cannot be used as a state directory")
+            tenant_config['stateDirectory'] = os.path.join('state', directory_name)
+            if tenant_config['stateDirectory'] in [other['stateDirectory'] for other in new_tenant_configs]:
+                raise ValueError("Tenant name " + name + " maps to the state directory of another tenant")
+        for section in tenant_sections:
+            tenant_config[section] = dict(data['ThousandEyes'].get(section) or {})
+            tenant_config[section].update(entry.get(section) or {})
+        for section, keys in required_tenant_keys.items():
+            for key in keys:
+                if key not in tenant_config[section]:
+                    raise KeyError(section + " of tenant " + name + " is missing " + key)
+        if tenant_config['Discovery'].get('namePattern'):
+            re.compile(tenant_config['Discovery']['namePattern'])
+        new_tenant_configs.append(tenant_config)
+    return new_tenant_configs
+
+
+def load_config():
+    global tenant_configs, tls_certificate
+    global collection_config, transport_config, publishing_config, daemon_config, config_mtime
+    global instrumentation_config, scheduling_config, response_cache_config
     logging.info("Opening configuration file " + config_file)
+    loaded_mtime = os.path.getmtime(config_file)
     with open(config_file) as f:
         data = yaml.safe_load(f)
         logging.debug("Full Config Loaded from file: "+str(data))
-        # Create the schema creation command
-        extension_dict={}
-        te_account_group=''
-        extension_host=''
-        try:
-            te_account_group=data['ThousandEyes']['TEConfig']['teAccountGroup']
-            extension_host=data['ThousandEyes']['AppDynamics']['hostname']
-        except Exception as error:
-            logging.warning("Failed to extract ThousandEyes id or hostname")
-        extension_schema.update({'AccountGroup': te_account_group} if te_account_group is not None else {})
-        extension_schema.update({'extensionHost': extension_host} if extension_host is not None else {})
-
-        schema_dict = {}
-        schema_dict.update(data['ThousandEyes']['Extension'])
-        schema_dict.update(data['ThousandEyes']['Test'])
-        schema_dict.update(data['ThousandEyes']['Metrics'])
-
-        if not os.path.exists("./createSchema.sh"):
-            appdynamics_create_schema(schema_dict)
-        for item in data['ThousandEyes']['Test']:
-            test_fields.append(item)
-        for item in data['ThousandEyes']['Metrics']:
-            metric_fields.append(item)
-        te_config = data['ThousandEyes']['TEConfig']
-        test_ids = te_config['tetestId']
-        appd_config = data['ThousandEyes']['AppDynamics']
-        tls_certificate= data['ThousandEyes']['TLSCertificate']
+    # Everything is parsed into locals first so that a broken file does not leave a half applied configuration
+    new_tenant_configs = get_tenant_configs(data)
+    new_tls_certificate = data['ThousandEyes']['TLSCertificate']
+
+    tenant_configs = new_tenant_configs
+    tls_certificate = new_tls_certificate
+    collection_config = data['ThousandEyes'].get('Collection') or {}
+    transport_config = data['ThousandEyes'].get('Transport') or {}
+    publishing_config = data['ThousandEyes'].get('Publishing') or {}
+    daemon_config = data['ThousandEyes'].get('Daemon') or {}
+    instrumentation_config = data['ThousandEyes'].get('Instrumentation') or {}
+    scheduling_config = data['ThousandEyes'].get('Scheduling') or {}
+    response_cache_config = data['ThousandEyes'].get('ResponseCache') or {}
+    config_mtime = loaded_mtime
+    apply_settings()
+
+
+def apply_settings():
+    # Settings shared by all tenants, the credentials, destination and tests of each tenant are applied by Tenant.configure
+    global certificate_bundle
+    global collection_workers, per_host_concurrency, collection_deadline, incremental_collection, max_backfill_seconds
+    global pool_size, connect_timeout, read_timeout, max_retries, backoff_factor, daemon_interval, streaming_enabled
+    global machine_agent_metrics, metric_prefix, prometheus_port, prometheus_address
+    global scheduling_enabled, ingestion_lag, spread_seconds
+    global response_cache_enabled, response_cache_entries, negative_cache_ttl
+    certificate_bundle=get_verification(tls_certificate)
+
+    collection_workers = int(collection_config.get('workers', 8))
+    logging.debug("Setting collection workers = "+str(collection_workers))
+    per_host_concurrency = int(collection_config.get('perHostConcurrency', 4))
+    logging.debug("Setting per host concurrency = "+str(per_host_concurrency))
+    collection_deadline = float(collection_config.get('deadlineSeconds', 100))
+    logging.debug("Setting collection deadline in seconds = "+str(collection_deadline))
+    incremental_collection = bool(collection_config.get('incremental', True))
+    logging.debug("Setting incremental collection = "+str(incremental_collection))
+    max_backfill_seconds = int(collection_config.get('maxBackfillSeconds', 3600))
+    logging.debug("Setting maximum backfill in seconds = "+str(max_backfill_seconds))
+    streaming_enabled = bool(collection_config.get('streaming', False))
+    if streaming_enabled and ijson is None:
+        logging.warning("Streaming collection requires the ijson package, falling back to full response parsing")
+        streaming_enabled = False
+    logging.debug("Setting streaming collection = "+str(streaming_enabled))
+
+    scheduling_enabled = bool(scheduling_config.get('enabled', True))
+    logging.debug("Setting interval aware scheduling = "+str(scheduling_enabled))
+    ingestion_lag = int(scheduling_config.get('ingestionLag', 30))
+    logging.debug("Setting round ingestion lag in seconds = "+str(ingestion_lag))
+    spread_seconds = float(scheduling_config.get('spreadSeconds', 0))
+    logging.debug("Setting poll spread in seconds = "+str(spread_seconds))
+
+    response_cache_enabled = bool(response_cache_config.get('enabled', True))
+    logging.debug("Setting response cache = "+str(response_cache_enabled))
+    response_cache_entries = int(response_cache_config.get('maxEntries', 1000))
+    logging.debug("Setting maximum response cache entries per tenant = "+str(response_cache_entries))
+    negative_cache_ttl = int(response_cache_config.get('negativeTTL', 3600))
+    logging.debug("Setting negative response cache TTL in seconds = "+str(negative_cache_ttl))
+
+    pool_size = int(transport_config.get('poolSize', max(per_host_concurrency, 10)))
+    logging.debug("Setting connection pool size per upstream = "+str(pool_size))
+    connect_timeout = float(transport_config.get('connectTimeout', 5))
+    logging.debug("Setting connect timeout in seconds = "+str(connect_timeout))
+    read_timeout = float(transport_config.get('readTimeout', 30))
+    logging.debug("Setting read timeout in seconds = "+str(read_timeout))
+    max_retries = int(transport_config.get('retries', 3))
+    logging.debug("Setting retries on 429/5xx = "+str(max_retries))
+    backoff_factor = float(transport_config.get('backoffFactor', 0.5))
+    logging.debug("Setting retry backoff factor = "+str(backoff_factor))
+
+    daemon_interval = float(daemon_config.get('interval', 120))
+    logging.debug("Setting daemon collection interval in seconds = "+str(daemon_interval))
+
+    machine_agent_metrics = bool(instrumentation_config.get('machineAgentMetrics', True))
+    logging.debug("Setting Machine Agent custom metrics output = "+str(machine_agent_metrics))
+    metric_prefix = str(instrumentation_config.get('metricPrefix', 'Custom Metrics|ThousandEyes')).rstrip('|')
+    logging.debug("Setting Machine Agent metric prefix = "+metric_prefix)
+    prometheus_port = int(instrumentation_config.get('prometheusPort', 0))
+    logging.debug("Setting Prometheus metrics port = "+str(prometheus_port))
+    prometheus_address = str(instrumentation_config.get('prometheusAddress', '127.0.0.1'))
+    logging.debug("Setting Prometheus metrics address = "+prometheus_address)
+
+
+try:
+    load_config()
 except Exception as err:
     logging.error("Failed to parse te_appd.yml in the following directory " + os.getcwd())
     logging.error(err)
+    sys.exit(1)
 
 
-username = te_config['teUsername']
-logging.debug("Setting thousand eyes username = "+username)
-api_key = te_config['teKey']
-logging.debug("Setting thousand eyes api_key = "+api_key)
-te_api = te_config['teAPI']
-logging.debug("Setting thousand eyes API URL = "+te_api)
-account_group = te_config['teAccountGroup']
-logging.debug("Setting thousand eyes Account Group = "+account_group)
-logging.debug("Setting authentication to username + API key")
-te_auth_user=HTTPBasicAuth(username,api_key)
+class MetricsRegistry(object):
+    """Thread safe counters, gauges and latency histograms keyed by metric name and a tuple of label values."""
 
+    buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
 
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
 
-def get_verification(tls_certificate):
-    if(tls_certificate):
-        logging.info("Certificate has been changed using configuration yaml")
-        logging.debug("New certificate path is "+ str(tls_certificate['certificateBundlePath']))
-        return tls_certificate['certificateBundlePath']
-    else:
-        logging.info("Certificate has not been set defaults to verification False")
-        return False
+    def increment(self, name, labels=(), value=1):
+        with self.lock:
+            self.counters[(name, labels)] = self.counters.get((name, labels), 0) + value
 
+    def set_gauge(self, name, labels, value):
+        with self.lock:
+            self.gauges[(name, labels)] = value
 
-certificate_bundle=get_verification(tls_certificate)
+    def observe(self, name, labels, seconds):
+        with self.lock:
+            histogram = self.histograms.get((name, labels))
+            if histogram is None:
+                # Bucket counts, sum, count, max
+                histogram = self.histograms[(name, labels)] = [0] * len(self.buckets) + [0.0, 0, 0.0]
+            for index, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram[index] += 1
+            histogram[-3] += seconds
+            histogram[-2] += 1
+            histogram[-1] = max(histogram[-1], seconds)
 
-def get_thousandeyes_accountid():
-    logging.info("Extracting the account-group for user")
-    accounts_url = te_api + "account-groups"
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.histograms.clear()
+
+    def machine_agent_lines(self, prefix):
+        # Machine Agent custom metrics only accept integer values, times are reported in milliseconds
+        lines = []
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append((machine_agent_path(prefix, name, labels), int(value), 'SUM'))
+            for (name, labels), value in sorted(self.gauges.items()):
+                lines.append((machine_agent_path(prefix, name, labels), int(value), 'OBSERVATION'))
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                path = machine_agent_path(prefix, name, labels)
+                lines.append((path + "|Count", histogram[-2], 'SUM'))
+                lines.append((path + "|Average Time (ms)", int(histogram[-3] * 1000 / histogram[-2]), 'AVERAGE'))
+                lines.append((path + "|Max Time (ms)", int(histogram[-1] * 1000), 'OBSERVATION'))
+        return ["name=" + path + ",value=" + str(value) + ",aggregator=" + aggregator for path, value, aggregator in lines]
+
+    def prometheus_text(self, label_names):
+        lines = []
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                metric = prometheus_name(name) + "_total"
+                add_prometheus_type(lines, metric, "counter")
+                lines.append(metric + prometheus_labels(label_names.get(name, ()), labels) + " " + str(value))
+            for (name, labels), value in sorted(self.gauges.items()):
+                metric = prometheus_name(name)
+                add_prometheus_type(lines, metric, "gauge")
+                lines.append(metric + prometheus_labels(label_names.get(name, ()), labels) + " " + str(value))
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                metric = prometheus_name(name) + "_seconds"
+                add_prometheus_type(lines, metric, "histogram")
+                names = label_names.get(name, ())
+                for index, bound in enumerate(self.buckets):
+                    lines.append(metric + "_bucket" + prometheus_labels(names + ('le',), labels + (str(bound),)) + " " + str(histogram[index]))
+                lines.append(metric + "_bucket" + prometheus_labels(names + ('le',), labels + ('+Inf',)) + " " + str(histogram[-2]))
+                lines.append(metric + "_sum" + prometheus_labels(names, labels) + " " + str(round(histogram[-3], 6)))
+                lines.append(metric + "_count" + prometheus_labels(names, labels) + " " + str(histogram[-2]))
+        return "\n".join(lines) + "\n"
+
+
+def add_prometheus_type(lines, metric, metric_type):
+    type_line = "# TYPE " + metric + " " + metric_type
+    if type_line not in lines:
+        lines.append(type_line)
+
+
+def machine_agent_path(prefix, name, labels):
+    segments = [prefix, name] + [str(label) for label in labels]
+    return "|".join(segment.replace(",", "-").replace("=", "-").replace(":", "-") for segment in segments)
+
+
+def prometheus_name(name):
+    return "appdte_" + "".join(character if character.isalnum() else "_" for character in name.lower())
+
+
+def prometheus_labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(label + "=\"" + str(value).replace("\"", "'") + "\"" for label, value in zip(names, values)) + "}"
+
+
+# Label names per metric, used for the Prometheus rendering only
+metric_label_names = {
+    'Requests': ('upstream', 'endpoint', 'status'),
+    'Request Time': ('upstream', 'endpoint'),
+    'Phase Time': ('phase',),
+    'Tests': ('result',),
+    'Rate Limit Wait Time': (),
+    'Rate Limit Requests Per Minute': (),
+    'Response Cache': ('result',)
+}
+# Cumulative since start for Prometheus, reset after every cycle for the Machine Agent
+total_metrics = MetricsRegistry()
+cycle_metrics = MetricsRegistry()
+
+
+def count_metric(name, labels=(), value=1):
+    total_metrics.increment(name, labels, value)
+    cycle_metrics.increment(name, labels, value)
+
+
+def observe_metric(name, labels, seconds):
+    total_metrics.observe(name, labels, seconds)
+    cycle_metrics.observe(name, labels, seconds)
+
+
+def set_gauge_metric(name, labels, value):
+    total_metrics.set_gauge(name, labels, value)
+    cycle_metrics.set_gauge(name, labels, value)
+
+
+def get_upstream_name(url):
+    if '/events/' in urlparse(url).path:
+        return 'AppDynamics'
+    return 'ThousandEyes'
+
+
+def get_endpoint_name(url):
+    # net/metrics/123.json -> net/metrics, events/publish/<schema> -> events/publish
+    segments = [segment for segment in urlparse(url).path.split('/') if segment]
+    if 'events' in segments:
+        return '/'.join(segments[segments.index('events'):segments.index('events') + 2])
+    if segments and segments[0][:1] == 'v' and segments[0][1:].isdigit():
+        segments = segments[1:]
+    if segments and segments[-1].endswith('.json'):
+        stem = segments[-1][:-len('.json')]
+        segments = segments[:-1] if stem.isdigit() else segments[:-1] + [stem]
+    return '/'.join(segments[:2])
+
+
+def run_timed_phase(phase, function, *args):
+    started = time.time()
+    try:
+        return function(*args)
+    finally:
+        observe_metric('Phase Time', (phase,), time.time() - started)
+
+
+def print_machine_agent_metrics():
+    if not machine_agent_metrics:
+        return
+    lines = cycle_metrics.machine_agent_lines(metric_prefix)
+    if lines:
+        sys.stdout.write("\n".join(lines) + "\n")
+        sys.stdout.flush()
+
+
+class PrometheusHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = total_metrics.prometheus_text(metric_label_names).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug("Prometheus endpoint: " + format % args)
+
+
+def start_prometheus_endpoint():
+    try:
+        server = HTTPServer((prometheus_address, prometheus_port), PrometheusHandler)
+    except (IOError, OSError) as e:
+        logging.error("Failed to start the Prometheus endpoint on " + prometheus_address + ":" + str(prometheus_port))
+        logging.error(e)
+        return None
+    thread = threading.Thread(target=server.serve_forever, name="prometheus-endpoint")
+    thread.daemon = True
+    thread.start()
+    logging.info("Serving Prometheus metrics on http://" + prometheus_address + ":" + str(prometheus_port) + "/metrics")
+    return server
+
+
+run_deadline = None
+host_semaphores = {}
+host_semaphores_lock = threading.Lock()
+# Per thread tenant, and priority and deadline of the test being collected, requests outside a test are served first
+request_context = threading.local()
+
+
+def current_tenant():
+    return request_context.tenant
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+def get_deadline():
+    # Collection threads keep the deadline of the cycle they were started in, a shutdown moves the global one to now
+    deadlines = [deadline for deadline in (run_deadline, getattr(request_context, 'deadline', None)) if deadline is not None]
+    return min(deadlines) if deadlines else None
+
+
+def check_deadline():
+    deadline = get_deadline()
+    if deadline is not None and time.time() > deadline:
+        raise DeadlineExceeded("Collection deadline of " + str(collection_deadline) + " seconds exceeded")
+
+
+def clamp_timeout(timeout, until):
+    # Connect and read timeouts of a request that has to finish by until
+    remaining = max(0.001, until - time.time())
+    if isinstance(timeout, tuple):
+        return tuple(min(part, remaining) if part is not None else remaining for part in timeout)
+    return min(timeout, remaining) if timeout is not None else remaining
+
+
+def get_host_semaphore(url):
+    host = urlparse(url).netloc
+    with host_semaphores_lock:
+        if host not in host_semaphores:
+            host_semaphores[host] = threading.BoundedSemaphore(per_host_concurrency)
+        return host_semaphores[host]
+
+
+def get_retry_after(value):
+    # Retry-After is either a number of seconds or an HTTP date
+    if not value:
+        return None
+    try:
+        return max(0, float(value))
+    except ValueError:
+        parsed = parsedate_tz(value)
+        return max(0, mktime_tz(parsed) - time.time()) if parsed else None
+
+
+def get_header_number(headers, names):
+    for name in names:
+        try:
+            return float(headers[name])
+        except (KeyError, TypeError, ValueError):
+            continue
+    return None
+
+
+class RateLimiter(object):
+    """Token bucket shared by every ThousandEyes request, the rate follows the quota reported in the response headers."""
+
+    limit_headers = ('X-Organization-Rate-Limit-Limit', 'X-RateLimit-Limit')
+    remaining_headers = ('X-Organization-Rate-Limit-Remaining', 'X-RateLimit-Remaining')
+    reset_headers = ('X-Organization-Rate-Limit-Reset', 'X-RateLimit-Reset')
+
+    def __init__(self, rate_limit_config):
+        self.condition = threading.Condition()
+        self.waiting = []
+        self.sequence = 0
+        self.paused_until = 0
+        self.quota_reset = 0
+        self.configure(rate_limit_config)
+
+    def configure(self, rate_limit_config):
+        with self.condition:
+            self.configured_rate = max(1, float(rate_limit_config.get('requestsPerMinute', 240))) / 60.0
+            self.ceiling = self.configured_rate
+            self.rate = self.configured_rate
+            self.capacity = max(1, int(rate_limit_config.get('burst', 10)))
+            self.tokens = float(self.capacity)
+            self.updated = time.time()
+            self.priority_tests = [str(test_id) for test_id in rate_limit_config.get('priorityTests') or []]
+            self.condition.notify_all()
+
+    def get_priority(self, test_id, index):
+        # Lower sorts first: tests listed under priorityTests in their listed order, then the others in cycle order
+        if str(test_id) in self.priority_tests:
+            return (0, self.priority_tests.index(str(test_id)))
+        return (1, index)
+
+    def refill(self, now):
+        if self.quota_reset and now >= self.quota_reset:
+            # A new quota window started, the next response reports how much of it is left
+            self.quota_reset = 0
+            self.rate = self.ceiling
+            self.tokens = max(self.tokens, 1)
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, priority, enforce_deadline=True):
+        # Waiting requests are served in priority order, a request only takes a token once it heads the queue
+        started = time.time()
+        with self.condition:
+            self.sequence += 1
+            ticket = (priority, self.sequence)
+            self.waiting.append(ticket)
+            try:
+                while True:
+                    if enforce_deadline:
+                        check_deadline()
+                    now = time.time()
+                    self.refill(now)
+                    if now < self.paused_until:
+                        wait = self.paused_until - now
+                    elif min(self.waiting) != ticket:
+                        wait = 0.5
+                    elif self.tokens >= 1:
+                        self.tokens -= 1
+                        break
+                    else:
+                        wait = (1 - self.tokens) / self.rate
+                    self.condition.wait(min(wait, 0.5))
+            finally:
+                self.waiting.remove(ticket)
+                self.condition.notify_all()
+        observe_metric('Rate Limit Wait Time', (), time.time() - started)
+
+    def update(self, response):
+        now = time.time()
+        headers = response.headers
+        limit = get_header_number(headers, self.limit_headers)
+        remaining = get_header_number(headers, self.remaining_headers)
+        reset = get_header_number(headers, self.reset_headers)
+        with self.condition:
+            self.refill(now)
+            if limit:
+                # The ThousandEyes limit is per minute and shared by the whole organization
+                self.ceiling = min(self.configured_rate, limit / 60.0)
+            if response.status_code == 429:
+                retry_after = get_retry_after(headers.get('Retry-After'))
+                self.paused_until = max(self.paused_until, now + (retry_after if retry_after is not None else 60))
+                self.quota_reset = self.paused_until
+                self.tokens = 0
+                self.rate = max(self.ceiling / 60, self.rate / 2)
+                logging.warning("Thousand eyes rate limit reached, pausing requests until " + time.strftime('%H:%M:%S', time.localtime(self.paused_until)))
+            elif remaining is not None and reset is not None:
+                # The reset header is either an epoch timestamp or the seconds left in the current window
+                seconds_left = max(1, reset - now if reset > 1000000000 else reset)
+                self.quota_reset = now + seconds_left
+                if remaining < 1:
+                    self.paused_until = max(self.paused_until, now + seconds_left)
+                self.rate = min(self.ceiling, max(self.ceiling / 60, remaining / seconds_left))
+                self.tokens = min(self.tokens, remaining)
+            else:
+                self.rate = min(self.ceiling, self.rate + self.ceiling / 10)
+            set_gauge_metric('Rate Limit Requests Per Minute', (), int(self.rate * 60))
+            self.condition.notify_all()
+
+
+# Tenants with the same ThousandEyes credentials share the quota of their organization and therefore a rate limiter
+rate_limiters = {}
+rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(te_api, username, rate_limit_config):
+    key = te_api + "|" + username
+    with rate_limiters_lock:
+        if key not in rate_limiters:
+            rate_limiters[key] = RateLimiter(rate_limit_config)
+        else:
+            rate_limiters[key].configure(rate_limit_config)
+        return rate_limiters[key]
+
+
+def get_request_priority():
+    return getattr(request_context, 'priority', (-1, 0))
+
+
+sessions = {}
+sessions_lock = threading.Lock()
+
+
+class DeadlineRetry(Retry):
+    """urllib3 Retry that gives up once a retry could no longer start before the deadline of the request."""
+
+    def increment(self, *args, **kwargs):
+        retry = super(DeadlineRetry, self).increment(*args, **kwargs)
+        deadline = getattr(request_context, 'request_deadline', None)
+        if deadline is not None and time.time() + retry.get_backoff_time() >= deadline:
+            # Exhausting the retries makes urllib3 raise the error or return the last response as usual
+            return retry.new(total=0).increment(*args, **kwargs)
+        return retry
+
+
+def build_retry(status_forcelist, retry_methods):
+    # Read errors and the listed statuses are only retried for retry_methods, connection errors for every method
+    retry_settings = {
+        'total': max_retries,
+        'backoff_factor': backoff_factor,
+        'status_forcelist': status_forcelist,
+        'respect_retry_after_header': True,
+        'raise_on_status': False
+    }
+    retry_methods = frozenset(retry_methods)
+    try:
+        return DeadlineRetry(allowed_methods=retry_methods, **retry_settings)
+    except TypeError:
+        # urllib3 versions older than 1.26
+        return DeadlineRetry(method_whitelist=retry_methods, **retry_settings)
+
+
+def get_session(url):
+    # One keep-alive session per upstream so that TCP/TLS handshakes and the CA bundle are reused across requests
+    parsed_url = urlparse(url)
+    upstream = parsed_url.scheme + "://" + parsed_url.netloc
+    with sessions_lock:
+        if upstream not in sessions:
+            logging.debug("Creating pooled session for upstream " + upstream)
+            session = requests.Session()
+            if get_upstream_name(url) == 'ThousandEyes':
+                # 429 responses of the ThousandEyes API are retried by send_request so that the rate limiter sees them
+                retry = build_retry([500, 502, 503, 504], ['GET'])
+            else:
+                # Event batches are POSTed and retried by the publisher only, a second retry layer here multiplied
+                # the requests during an outage and retried POSTs that may already have been ingested
+                retry = build_retry([429, 500, 502, 503, 504], ['GET', 'PATCH'])
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            session.verify = certificate_bundle
+            sessions[upstream] = session
+        return sessions[upstream]
+
+
+def send_request(method, url, enforce_deadline=True, **kwargs):
+    # Every upstream call goes through here so the per-host cap, the run deadline and the
+    # ThousandEyes rate limit apply to all of them
+    upstream = get_upstream_name(url)
+    rate_limited = upstream == 'ThousandEyes'
+    attempt = 0
+    while True:
+        response = send_single_request(method, url, enforce_deadline, rate_limited, **kwargs)
+        if not rate_limited:
+            return response
+        current_tenant().rate_limiter.update(response)
+        if response.status_code != 429 or attempt >= max_retries:
+            return response
+        attempt += 1
+        response.close()
+
+
+def send_single_request(method, url, enforce_deadline, rate_limited, **kwargs):
+    if enforce_deadline:
+        check_deadline()
+    if rate_limited:
+        current_tenant().rate_limiter.acquire(get_request_priority(), enforce_deadline)
+    kwargs.setdefault('timeout', (connect_timeout, read_timeout))
+    semaphore = get_host_semaphore(url)
+    while not semaphore.acquire(False):
+        if enforce_deadline:
+            check_deadline()
+        time.sleep(0.05)
+    upstream = get_upstream_name(url)
+    endpoint = get_endpoint_name(url)
+    status = 'error'
+    # An in-flight request ends at the deadline as well, DeadlineRetry reads it to stop the urllib3 retries
+    request_context.request_deadline = get_deadline() if enforce_deadline else None
+    if request_context.request_deadline is not None:
+        kwargs['timeout'] = clamp_timeout(kwargs['timeout'], request_context.request_deadline)
+    started = time.time()
+    try:
+        response = get_session(url).request(method, url, **kwargs)
+        status = str(response.status_code)
+        return response
+    finally:
+        request_context.request_deadline = None
+        semaphore.release()
+        observe_metric('Request Time', (upstream, endpoint), time.time() - started)
+        count_metric('Requests', (upstream, endpoint, status))
+
+
+account_group_cache_file = os.path.join('state', 'account_groups.json')
+account_group_cache = {}
+# Guards the cache and the per account group locks, lookups only hold the lock of their own account group
+account_group_lock = threading.Lock()
+account_group_locks = {}
+
+
+def load_account_group_cache():
+    try:
+        with open(account_group_cache_file) as f:
+            account_group_cache.update(json.load(f))
+            logging.debug("Loaded account group cache from " + account_group_cache_file)
+    except (IOError, OSError, ValueError):
+        logging.debug("No usable account group cache found at " + account_group_cache_file)
+
+
+def save_account_group_cache():
+    temp_file = account_group_cache_file + ".tmp"
+    try:
+        with open(temp_file, 'w') as f:
+            json.dump(account_group_cache, f)
+        os.rename(temp_file, account_group_cache_file)
+    except (IOError, OSError) as e:
+        logging.warning("Failed to persist account group cache to " + account_group_cache_file)
+        logging.debug(e)
+
+
+def fetch_thousandeyes_accountid():
+    tenant = current_tenant()
+    logging.info("Extracting the account-group for user of tenant " + tenant.name)
+    accounts_url = tenant.te_api + "account-groups"
     headers = {
         'accept': 'application/json',
         'content-type': 'application/json'
     }
 
-    response = requests.request('GET', accounts_url, headers=headers, auth=te_auth_user, verify=certificate_bundle)
+    response = send_request('GET', accounts_url, headers=headers, auth=tenant.te_auth_user)
     if(response.status_code>299):
         logging.warning("Failed to extract account groups for thousand eyes username")
-        logging.debug("Failed to extract thousandeyes account group using url "+accounts_url +" and authentication user "+username)
+        logging.debug("Failed to extract thousandeyes account group using url "+accounts_url +" and authentication user "+tenant.username)
     try:
         accounts = response.json()['accountGroups']
         for account in accounts:
-            if account['accountGroupName'] == account_group:
+            if account['accountGroupName'] == tenant.account_group:
                 return account['aid']
     except(KeyError):
         logging.error(KeyError)
 
 
-def get_appdynamics_schema():
-    events_service_url = appd_config['appdEventsService']
-    schema_name = appd_config['schemaName']
-    retrieve_schema_url = events_service_url + "/events/schema/" + schema_name
-    api_key = appd_config['analyticsApiKey']
-    account_name = appd_config['globalAccountName']
-    headers = {
-        'X-Events-API-AccountName': account_name,
-        'X-Events-API-Key': api_key,
-        'Content-type': 'application/vnd.appd.events+json;v=2'
+def get_account_group_lock(cache_key):
+    with account_group_lock:
+        if cache_key not in account_group_locks:
+            account_group_locks[cache_key] = threading.Lock()
+        return account_group_locks[cache_key]
+
+
+def get_thousandeyes_accountid():
+    # Concurrent workers of the same account group wait for a single lookup instead of all issuing their own,
+    # other tenants are not held up by it
+    tenant = current_tenant()
+    cache_key = tenant.te_api + "|" + tenant.username + "|" + tenant.account_group
+    with get_account_group_lock(cache_key):
+        with account_group_lock:
+            cached = account_group_cache.get(cache_key)
+        if cached and time.time() - cached['resolvedAt'] < tenant.account_group_cache_ttl:
+            return cached['aid']
+        aid = run_timed_phase('Account Group', fetch_thousandeyes_accountid)
+        if aid is not None:
+            logging.debug("Caching thousand eyes account group id " + str(aid) + " for " + tenant.account_group)
+            with account_group_lock:
+                account_group_cache[cache_key] = {'aid': aid, 'resolvedAt': time.time()}
+                save_account_group_cache()
+        return aid
+
+
+load_account_group_cache()
+
+
+def get_schema_headers():
+    appd_config = current_tenant().appd_config
+    return {
+        'X-Events-API-AccountName': appd_config['globalAccountName'],
+        'X-Events-API-Key': appd_config['analyticsApiKey'],
+        'Content-type': 'application/vnd.appd.events+json;v=2',
+        'Accept': 'application/vnd.appd.events+json;v=2'
     }
-    schema = {}
+
+
+def get_schema_url():
+    appd_config = current_tenant().appd_config
+    return appd_config['appdEventsService'] + "/events/schema/" + appd_config['schemaName']
+
+
+def get_appdynamics_schema():
+    # Returns None when the schema does not exist yet
     try:
-        response = requests.request("GET", retrieve_schema_url, headers=headers, verify=certificate_bundle)
-        schema = response.json()
-        if(response.status_code==404):
-            logging.error("Cannot retrieve Analytics Schema")
-            logging.error("Run createSchema.sh and validate the schema has been created in AppDynamics")
+        response = send_request("GET", get_schema_url(), headers=get_schema_headers())
     except requests.exceptions.RequestException as e:  # This is the correct syntax
         logging.error("Failed to collect information on the AppDynamics analytics schema")
         logging.error(e)
         raise SystemExit(e)
-    return schema
+    if response.status_code == 404:
+        return None
+    if response.status_code > 299:
+        logging.error("Cannot retrieve Analytics Schema, request failed with code: " + str(response.status_code))
+        logging.debug("Retrieving Analytics Schema failed with response: " + response.text)
+        raise SystemExit("Cannot retrieve Analytics Schema")
+    try:
+        return response.json()['schema']
+    except (KeyError, ValueError):
+        logging.error("Cannot parse the Analytics Schema returned by the Events Service")
+        raise SystemExit("Cannot parse Analytics Schema")
 
 
-def update_appdynamics_schema():
-    schema_old={}
+def create_appdynamics_schema():
+    payload = json.dumps({'schema': current_tenant().schema_dict})
+    logging.info("Creating custom schema " + current_tenant().appd_config['schemaName'] + " with fields: " + payload)
     try:
-        schema_old = get_appdynamics_schema()['schema']
-    except(KeyError):
-        logging.error("Cannot retrieve Analytics Schema")
-        logging.error("Run createSchema.sh and validate the schema has been created in AppDynamics")
-        sys.exit()
+        response = send_request("POST", get_schema_url(), headers=get_schema_headers(), data=payload)
+    except requests.exceptions.RequestException as e:
+        logging.error("Failed to create Appdynamics Custom Schema")
+        logging.error(e)
+        raise SystemExit(e)
+    if response.status_code > 299:
+        logging.error("Creating Appdynamics Custom Schema failed with code: " + str(response.status_code))
+        logging.debug("Creating Appdynamics Custom Schema failed with response: " + response.text)
+        raise SystemExit("Cannot create Analytics Schema")
+
+
+def update_appdynamics_schema():
+    schema_old = get_appdynamics_schema()
+    if schema_old is None:
+        create_appdynamics_schema()
+        return
     set_1 = set(schema_old.items())
-    set_2 = set(schema_dict.items())
+    set_2 = set(current_tenant().schema_dict.items())
     difference = dict(set_2 - set_1)
     if (difference):
         diff_payload = {}
         diff_payload.update({'add': difference})
-        events_service_url = appd_config['appdEventsService']
-        schema_name = appd_config['schemaName']
-        events_service_url = events_service_url + "/events/schema/" + schema_name
-        api_key = appd_config['analyticsApiKey']
-        account_name = appd_config['globalAccountName']
-        headers = {
-            'X-Events-API-AccountName': account_name,
-            'X-Events-API-Key': api_key,
-            'Content-type': 'application/vnd.appd.events+json;v=2',
-            'Accept-type': 'Accept: application/vnd.appd.events+json;v=2'
-        }
         payload = "[" + json.dumps(diff_payload) + "]"
         try:
             logging.info("Updating custom schema fields: " + payload)
-            response = requests.patch(events_service_url, headers=headers, data=payload , verify=certificate_bundle)
+            response = send_request("PATCH", get_schema_url(), headers=get_schema_headers(), data=payload)
         except requests.exceptions.RequestException as e:  # This is the correct syntax
             logging.error("Failed to update Appdynamics Custom Schema")
-            logging.error(e.message)
+            logging.error(e)
             raise SystemExit(e)
+        if response.status_code > 299:
+            logging.error("Updating Appdynamics Custom Schema failed with code: " + str(response.status_code))
+            logging.debug("Updating Appdynamics Custom Schema failed with response: " + response.text)
+            raise SystemExit("Cannot update Analytics Schema")
 
 
-def post_appdynamics_data(data):
+def get_schema_fingerprint():
+    # Covers the field set and the destination, a change in either requires a new check against the Events Service
+    tenant = current_tenant()
+    appd_config = tenant.appd_config
+    fingerprint_source = json.dumps([appd_config['appdEventsService'], appd_config['globalAccountName'],
+                                     appd_config['schemaName'], tenant.schema_dict], sort_keys=True)
+    return hashlib.sha256(fingerprint_source.encode('utf-8')).hexdigest()
+
+
+def sync_appdynamics_schema():
+    tenant = current_tenant()
+    schema_state_file = tenant.schema_state_file
+    fingerprint = get_schema_fingerprint()
+    try:
+        with open(schema_state_file) as f:
+            schema_state = json.load(f)
+    except (IOError, OSError, ValueError):
+        schema_state = {}
+    if schema_state.get('fingerprint') == fingerprint and time.time() - schema_state.get('validatedAt', 0) < tenant.schema_revalidation_interval:
+        logging.debug("Analytics Schema unchanged since " + time.ctime(schema_state['validatedAt']) + ", skipping schema check")
+        return
+    update_appdynamics_schema()
+    temp_file = schema_state_file + ".tmp"
+    try:
+        with open(temp_file, 'w') as f:
+            json.dump({'fingerprint': fingerprint, 'validatedAt': time.time()}, f)
+        os.rename(temp_file, schema_state_file)
+    except (IOError, OSError) as e:
+        logging.warning("Failed to persist the schema fingerprint to " + schema_state_file)
+        logging.debug(e)
+
+
+def post_appdynamics_batch(appd_config, payload, compressed=False, timeout=None):
     events_service_url = appd_config['appdEventsService']
     schema_name = appd_config['schemaName']
     events_service_url = events_service_url + "/events/publish/" + schema_name
@@ -306,174 +1042,1267 @@ def post_appdynamics_data(data):
         'X-Events-API-Key': api_key,
         'Content-type': 'application/vnd.appd.events+json;v=2'
     }
-    schema = json.dumps(data)
-    schema = "[" + schema + "]"
-    try:
-        logging.info("Pushing data into AppDynamics schema")
-        logging.debug("Pushing data into AppDynamics schema: "+schema)
-        response = requests.request("POST", events_service_url, headers=headers, data=schema , verify=certificate_bundle)
-        if(response.status_code>204):
+    if compressed:
+        headers['Content-Encoding'] = 'gzip'
+    request_options = {'timeout': timeout} if timeout else {}
+    # Collected events are still published once the collection deadline has passed
+    return send_request("POST", events_service_url, enforce_deadline=False, headers=headers, data=payload, **request_options)
+
+
+class EventSpool(object):
+    """Append-only spool of encoded events in segment files, written by the collection and read back in order."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.lock = threading.Lock()
+        self.position_file = os.path.join(directory, 'position.json')
+        self.active = None
+        self.active_name = None
+        self.active_started = 0
+        self.active_bytes = 0
+        self.segment_bytes = 1048576
+        self.max_bytes = 104857600
+        self.max_age = 86400
+        # Segments left by a previous run are sealed and replayed before the ones written by this run
+        self.sequence = max([int(name[len('segment-'):-len('.jsonl')]) for name in self.list_segments()] or [0])
+        self.position = self.load_position()
+
+    def configure(self, segment_bytes, max_bytes, max_age):
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+
+    def load_position(self):
+        try:
+            with open(self.position_file) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def save_position(self):
+        temp_file = self.position_file + ".tmp"
+        with open(temp_file, 'w') as f:
+            json.dump(self.position, f)
+        os.rename(temp_file, self.position_file)
+
+    def list_segments(self):
+        return sorted(name for name in os.listdir(self.directory) if name.startswith('segment-') and name.endswith('.jsonl'))
+
+    def append(self, encoded):
+        with self.lock:
+            if self.active is None:
+                self.sequence += 1
+                self.active_name = 'segment-%012d.jsonl' % self.sequence
+                self.active = open(os.path.join(self.directory, self.active_name), 'ab')
+                self.active_started = time.time()
+                self.active_bytes = 0
+            line = (encoded + "\n").encode('utf-8')
+            self.active.write(line)
+            self.active_bytes += len(line)
+            if self.active_bytes >= self.segment_bytes:
+                self.seal_active()
+
+    def seal(self, min_age=0):
+        # Seals the segment being written once its first event is at least min_age seconds old
+        with self.lock:
+            if self.active is not None and time.time() - self.active_started >= min_age:
+                self.seal_active()
+
+    def seal_active(self):
+        self.active.flush()
+        os.fsync(self.active.fileno())
+        self.active.close()
+        self.active = None
+
+    def sealed_segments(self):
+        with self.lock:
+            return [name for name in self.list_segments() if self.active is None or name != self.active_name]
+
+    def read_batch(self, max_events, max_bytes):
+        # Returns the segment, the offset after each event and the oldest events that have not been published yet
+        for name in self.sealed_segments():
+            offset = self.position.get('offset', 0) if self.position.get('segment') == name else 0
+            end = offset
+            offsets = []
+            batch = []
+            batch_bytes = 2
+            try:
+                with open(os.path.join(self.directory, name), 'rb') as f:
+                    f.seek(offset)
+                    for line in f:
+                        if batch and (len(batch) >= max_events or batch_bytes + len(line) > max_bytes):
+                            break
+                        end += len(line)
+                        if not line.endswith(b"\n"):
+                            logging.warning("Skipping truncated event at the end of spool segment " + name)
+                            # Committed together with the event before it
+                            if offsets:
+                                offsets[-1] = end
+                            continue
+                        batch.append(line[:-1].decode('utf-8'))
+                        offsets.append(end)
+                        batch_bytes += len(line)
+            except (IOError, OSError):
+                continue
+            if batch:
+                return name, offsets, batch
+            self.remove_segment(name)
+        return None, [], []
+
+    def commit(self, name, offset):
+        self.position = {'segment': name, 'offset': offset}
+        self.save_position()
+
+    def remove_segment(self, name):
+        try:
+            os.remove(os.path.join(self.directory, name))
+        except OSError:
+            pass
+        if self.position.get('segment') == name:
+            self.position = {}
+            self.save_position()
+
+    def count_events(self, name):
+        offset = self.position.get('offset', 0) if self.position.get('segment') == name else 0
+        try:
+            with open(os.path.join(self.directory, name), 'rb') as f:
+                f.seek(offset)
+                return sum(1 for line in f)
+        except (IOError, OSError):
+            return 0
+
+    def evict(self):
+        # Drops the oldest sealed segments while the spool is over its size cap or they are older than the age cap,
+        # returns the number of evicted events and the bytes left in the spool
+        now = time.time()
+        segments = []
+        spool_bytes = 0
+        for name in self.sealed_segments():
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            segments.append((name, stat.st_size, stat.st_mtime))
+            spool_bytes += stat.st_size
+        evicted = 0
+        for name, size, modified in segments:
+            if spool_bytes <= self.max_bytes and now - modified <= self.max_age:
+                break
+            evicted += self.count_events(name)
+            self.remove_segment(name)
+            spool_bytes -= size
+        return evicted, spool_bytes
+
+    def close(self):
+        self.seal()
+
+
+class EventPublisher(object):
+    """Spools events on disk and publishes them in order to the Events API in batches bounded by event count and payload bytes."""
+
+    def __init__(self, publishing_config, spool_directory, appd_config):
+        self.spool = EventSpool(spool_directory)
+        self.appd_config = appd_config
+        self.configure(publishing_config)
+        self.drain_lock = threading.Lock()
+        # Cleared when the Events Service answers 415 to a compressed request
+        self.gzip_accepted = True
+        # Set by close, also ends the retries of a batch the drain thread is publishing at that moment
+        self.close_deadline = None
+        self.stopped = threading.Event()
+        self.wakeup = threading.Event()
+        self.drainer = threading.Thread(target=self.drain_periodically, name="appd-publisher-" + spool_directory)
+        self.drainer.daemon = True
+        self.drainer.start()
+
+    def configure(self, publishing_config):
+        self.max_events = int(publishing_config.get('maxBatchEvents', 500))
+        self.max_bytes = int(publishing_config.get('maxBatchBytes', 900000))
+        self.flush_interval = float(publishing_config.get('flushInterval', 5))
+        self.retries = int(publishing_config.get('retries', 3))
+        self.backoff = float(publishing_config.get('backoffFactor', 1))
+        self.max_outage_backoff = float(publishing_config.get('maxOutageBackoff', 60))
+        self.drain_timeout = float(publishing_config.get('drainTimeout', 10))
+        self.gzip = bool(publishing_config.get('gzip', True))
+        self.gzip_min_bytes = int(publishing_config.get('gzipMinBytes', 1024))
+        self.spool.configure(int(publishing_config.get('segmentBytes', 1048576)),
+                             int(publishing_config.get('spoolMaxBytes', 104857600)),
+                             int(publishing_config.get('spoolMaxAgeSeconds', 86400)))
+
+    def publish(self, event):
+        # Collection only writes to the spool, publishing happens on the publisher thread
+        try:
+            self.spool.append(encode_json(event))
+            count_metric('Events Spooled', (), 1)
+        except (IOError, OSError) as e:
+            logging.error("Failed to write event to the spool under " + self.spool.directory + ", dropping it")
+            logging.debug(e)
+            count_metric('Events Dropped', (), 1)
+
+    def flush(self):
+        # Hands everything spooled so far to the publisher thread without waiting for it to be published
+        self.spool.seal()
+        self.wakeup.set()
+
+    def drain(self, until=None):
+        # Publishes the sealed segments oldest first, returns False when the Events Service is not available
+        with self.drain_lock:
+            evicted, spool_bytes = self.spool.evict()
+            set_gauge_metric('Spool Bytes', (), spool_bytes)
+            if evicted:
+                logging.warning("Evicted " + str(evicted) + " spooled events over the spool size or age limit")
+                count_metric('Events Evicted', (), evicted)
+            while until is None or time.time() < until:
+                segment, offsets, batch = self.spool.read_batch(self.max_events, self.max_bytes)
+                if not batch:
+                    return True
+                # A split batch can stop half way, the events published before that are not published again
+                published = self.send_batch(batch, until)
+                if published:
+                    self.spool.commit(segment, offsets[published - 1])
+                if published < len(batch):
+                    return False
+            return True
+
+    def drain_periodically(self):
+        failures = 0
+        while not self.stopped.is_set():
+            self.spool.seal(self.flush_interval)
+            wait = self.flush_interval
+            if self.drain():
+                failures = 0
+            else:
+                # The events stay spooled and are replayed in order once the Events Service is back
+                failures += 1
+                wait = min(self.max_outage_backoff, self.backoff * (2 ** failures))
+                logging.warning("Events Service unavailable, retrying the spooled events in " + str(wait) + " seconds")
+            self.wakeup.wait(wait)
+            self.wakeup.clear()
+
+    def close(self):
+        # Publishes what is left for at most drainTimeout seconds, anything else is published by the next run
+        self.close_deadline = time.time() + self.drain_timeout
+        self.stopped.set()
+        self.wakeup.set()
+        self.spool.close()
+        if not self.drain(self.close_deadline):
+            logging.warning("Events Service unavailable, spooled events are kept under " + self.spool.directory + " for the next run")
+
+    def send_batch(self, batch, until=None):
+        # Returns the number of leading events that were published or rejected by the Events Service, the rest should be
+        # retried later. Retries and request timeouts end at until so that closing the publisher keeps to drainTimeout
+        payload = "[" + ",".join(batch) + "]"
+        logging.debug("Pushing data into AppDynamics schema: " + payload)
+        body = payload.encode('utf-8')
+        uncompressed_bytes = len(body)
+        compressed = self.gzip and self.gzip_accepted and uncompressed_bytes >= self.gzip_min_bytes
+        if compressed:
+            body = gzip_compress(body)
+        logging.info("Pushing " + str(len(batch)) + " events (" + str(len(body)) + " bytes" + (" gzip" if compressed else "")
+                     + ") into AppDynamics schema")
+        rejected = False
+        for attempt in range(self.retries + 1):
+            if self.close_deadline is not None:
+                until = min(until or self.close_deadline, self.close_deadline)
+            if attempt:
+                wait = self.backoff * (2 ** (attempt - 1))
+                if until is not None and time.time() + wait >= until:
+                    logging.warning("Drain timeout reached, the batch stays spooled")
+                    return 0
+                time.sleep(wait)
+            timeout = None
+            if until is not None:
+                remaining = until - time.time()
+                if remaining <= 0:
+                    return 0
+                timeout = (min(connect_timeout, remaining), min(read_timeout, remaining))
+            started = time.time()
+            try:
+                response = post_appdynamics_batch(self.appd_config, body, compressed, timeout)
+            except requests.exceptions.RequestException as e:
+                observe_metric('Phase Time', ('Publish',), time.time() - started)
+                logging.warning("Failed to POST data to the AppDynamics analytics schema, attempt " + str(attempt + 1))
+                logging.debug(e)
+                continue
+            observe_metric('Phase Time', ('Publish',), time.time() - started)
+            if response.status_code < 300:
+                count_metric('Events Published', (), len(batch))
+                count_metric('Bytes Sent', (), len(body))
+                count_metric('Bytes Uncompressed', (), uncompressed_bytes)
+                return len(batch)
+            if response.status_code == 415 and compressed:
+                logging.warning("The Events Service does not accept gzip compressed requests, publishing uncompressed")
+                self.gzip_accepted = False
+                return self.send_batch(batch, until)
             logging.warning("POST data to AppDynamics failed with code: "+str(response.status_code))
             logging.debug("POST data to AppDynamics failed with response: "+response.text)
-    except requests.exceptions.RequestException as e:  # This is the correct syntax
-        logging.error("Failed to POST data to the AppDynamics analytics schema")
-        logging.error(e)
-        raise SystemExit(e)
+            if 400 <= response.status_code < 500 and response.status_code != 429:
+                # The Events Service rejected the content, retrying the same payload will not help
+                rejected = True
+                break
+        if not rejected:
+            return 0
+        if len(batch) > 1:
+            # Split the batch so that a single bad record does not drop the rest
+            middle = len(batch) // 2
+            published = self.send_batch(batch[:middle], until)
+            if published < middle:
+                return published
+            return middle + self.send_batch(batch[middle:], until)
+        logging.error("Dropping event rejected by AppDynamics")
+        logging.debug("Rejected event: " + batch[0])
+        count_metric('Events Dropped', (), 1)
+        return 1
+
+
+def post_appdynamics_data(data):
+    current_tenant().publisher.publish(data)
+
+
+# Status codes of an optional metric family that mean the test has no such data, e.g. web/page-load of a network test
+negative_statuses = (400, 403, 404)
+
+
+class ResponseCache(object):
+    """ThousandEyes responses of one tenant. Identical requests are answered once per cycle, responses with an ETag or
+    Last-Modified header are revalidated with conditional requests and endpoints without data are remembered."""
+
+    def __init__(self, negative_cache_file):
+        self.negative_cache_file = negative_cache_file
+        self.lock = threading.Lock()
+        self.cycle = 0
+        self.entries = OrderedDict()
+        self.negative_results = {}
+        self.load_negative_results()
+
+    def load_negative_results(self):
+        try:
+            with open(self.negative_cache_file) as f:
+                self.negative_results.update(json.load(f))
+        except (IOError, OSError, ValueError):
+            logging.debug("No usable negative response cache found at " + self.negative_cache_file)
+
+    def save_negative_results(self):
+        temp_file = self.negative_cache_file + ".tmp"
+        now = time.time()
+        try:
+            with self.lock:
+                for url in [url for url, expires in self.negative_results.items() if expires <= now]:
+                    del self.negative_results[url]
+                with open(temp_file, 'w') as f:
+                    json.dump(self.negative_results, f, separators=(',', ':'))
+            os.rename(temp_file, self.negative_cache_file)
+        except (IOError, OSError) as e:
+            logging.warning("Failed to persist the negative response cache to " + self.negative_cache_file)
+            logging.debug(e)
+
+    def end_cycle(self):
+        # Bodies without validators are only reused within the cycle that fetched them
+        with self.lock:
+            self.cycle += 1
+            for key in [key for key, entry in self.entries.items() if not entry['validators']]:
+                del self.entries[key]
+
+    def lookup(self, key):
+        # Returns the body fetched earlier in this cycle, otherwise None and the headers of a conditional request
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return None, {}
+            self.entries[key] = entry
+            if entry['cycle'] == self.cycle:
+                return entry['body'], {}
+            return None, dict(entry['validators'])
+
+    def store(self, key, response, body):
+        validators = {}
+        if response.headers.get('ETag'):
+            validators['If-None-Match'] = response.headers['ETag']
+        if response.headers.get('Last-Modified'):
+            validators['If-Modified-Since'] = response.headers['Last-Modified']
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = {'cycle': self.cycle, 'validators': validators, 'body': body}
+            while len(self.entries) > response_cache_entries:
+                self.entries.popitem(last=False)
+
+    def revalidated(self, key):
+        # The server answered 304 Not Modified, the cached body is current for this cycle as well
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            entry['cycle'] = self.cycle
+            return entry['body']
+
+    def is_negative(self, url):
+        with self.lock:
+            return self.negative_results.get(url, 0) > time.time()
+
+    def add_negative(self, url):
+        with self.lock:
+            self.negative_results[url] = time.time() + negative_cache_ttl
+
 
+def get_next_page_params(te_params, page):
+    # A long from/to window is split into pages, pages.next links the following page of the same request
+    next_link = (page.get('pages') or {}).get('next') if isinstance(page, dict) else page
+    if not next_link:
+        return None
+    page_params = dict(te_params)
+    page_params.update(parse_qsl(urlparse(next_link).query))
+    return page_params
 
-update_appdynamics_schema()
+
+def merge_te_page(test_json, page_json):
+    # The records of a following page are appended to the lists of the first page, e.g. net.metrics,
+    # the lists of the first page are copied since the cached body is shared
+    for section, families in page_json.items():
+        if not isinstance(families, dict) or not isinstance(test_json.get(section), dict):
+            continue
+        test_json[section] = dict(test_json[section])
+        for family, records in families.items():
+            if isinstance(records, list) and isinstance(test_json[section].get(family), list):
+                test_json[section][family] = test_json[section][family] + records
+    return test_json
 
 
-def get_metrics_and_update(url):
+def get_metrics_and_update(url, window_params=None, required=False):
     logging.debug("Pulling metrics from thousand eyes API: "+url)
-    payload = {}
-    metrics = {}
-    headers = {
-        'content-type': 'application/json',
-        'accept': 'application/json'
-    }
-    test_json = ''
-    params = {}
     te_params = {}
-    test_json = {}
+    tenant = current_tenant()
     try:
-        if (te_config['teAccountGroup']):
+        if (tenant.account_group):
             te_params.update({'aid': get_thousandeyes_accountid()})
     except(KeyError):
         logging.warning(KeyError)
         pass
+    if window_params:
+        te_params.update(window_params)
+    test_json = get_te_page(url, te_params, required)
+    page_params = get_next_page_params(te_params, test_json)
+    if page_params is not None:
+        test_json = dict(test_json)
+    while page_params is not None:
+        # A missing later page fails the whole family, its records would otherwise be skipped by the watermarks
+        page_json = get_te_page(url, page_params, True)
+        merge_te_page(test_json, page_json)
+        page_params = get_next_page_params(te_params, page_json)
+    return test_json
+
+
+def get_te_page(url, te_params, required=False):
+    headers = {
+        'content-type': 'application/json',
+        'accept': 'application/json'
+    }
+    test_json = {}
+    tenant = current_tenant()
+    # The test details and the metrics of a test are read from the same net/metrics request
+    cache_key = url + "|" + json.dumps(te_params, sort_keys=True)
+    validators = {}
+    if response_cache_enabled:
+        cached, validators = tenant.response_cache.lookup(cache_key)
+        if cached is not None:
+            count_metric('Response Cache', ('hit',))
+            return cached
     try:
-        response = requests.request("GET", url, headers=headers,auth=te_auth_user, verify=certificate_bundle) if params is None else requests.request("GET",
-                                                                                                                url,
-                                                                                                                headers=headers,
-                                                                                                                params=te_params, auth=te_auth_user, verify=certificate_bundle)
+        response = send_request("GET", url, headers=dict(headers, **validators), params=te_params, auth=tenant.te_auth_user)
+        if response.status_code == 304 and validators:
+            cached = tenant.response_cache.revalidated(cache_key)
+            if cached is not None:
+                count_metric('Response Cache', ('revalidated',))
+                return cached
+            # Evicted in the meantime, asked again without the validators
+            response = send_request("GET", url, headers=headers, params=te_params, auth=tenant.te_auth_user)
         if(response.status_code>299):
-            logging.warning("Pulling test metrics from thousand eyes failed with error code "+response.status_code)
+            message = "Pulling test metrics from thousand eyes failed with error code " + str(response.status_code) + ": " + url
+            if required:
+                logging.warning(message)
+            else:
+                logging.debug(message)
+                if response_cache_enabled and response.status_code in negative_statuses:
+                    tenant.response_cache.add_negative(url)
+            response.raise_for_status()
 
         test_json = response.json()
+    except requests.exceptions.HTTPError as e:
+        # Optional families without data for the test are expected and were already logged above
+        if required:
+            logging.error(e)
+        raise SystemExit(e)
     except requests.exceptions.RequestException as e:  # This is the correct syntax
         logging.error(e)
         raise SystemExit(e)
+    if response_cache_enabled:
+        tenant.response_cache.store(cache_key, response, test_json)
     return test_json
 
 
-def get_test_details(url):
-    payload = {}
+def stream_te_items(url, prefixes, window_params=None, required=False):
+    # Yields the prefix and object of the objects found at prefixes (ijson syntax, e.g. net.metrics.item) while the response is still being read,
+    # the following pages of a long from/to window are streamed after the first one
+    logging.debug("Streaming metrics from thousand eyes API: "+url)
+    tenant = current_tenant()
+    te_params = {}
+    if tenant.account_group:
+        te_params.update({'aid': get_thousandeyes_accountid()})
+    if window_params:
+        te_params.update(window_params)
+    page_params = te_params
+    while page_params is not None:
+        next_link = None
+        for prefix, item in stream_te_page(url, prefixes + ('pages.next',), page_params, required):
+            if prefix == 'pages.next':
+                next_link = item
+            else:
+                yield prefix, item
+        # A missing later page fails the whole family, its records would otherwise be skipped by the watermarks
+        required = True
+        page_params = get_next_page_params(te_params, next_link)
+
+
+def stream_te_page(url, prefixes, te_params, required):
     headers = {
         'content-type': 'application/json',
         'accept': 'application/json'
     }
-    test_json = ''
-    params = {}
-    te_params = {}
-    test_json = {}
-    try:
-        if (te_config['teAccountGroup']):
-            te_params.update({'aid': get_thousandeyes_accountid()})
-    except:
-        pass
+    tenant = current_tenant()
     try:
-        response = requests.request("GET", te_api_url, headers=headers, auth=te_auth_user, verify=certificate_bundle) if params is None else requests.request("GET",
-                                                                                                                te_api_url,
-                                                                                                                headers=headers,
-                                                                                                                params=te_params,auth=te_auth_user, verify=certificate_bundle)
-        test_json = response.json()
-    except requests.exceptions.RequestException as e:  # This is the correct syntax
+        response = send_request("GET", url, headers=headers, params=te_params, auth=tenant.te_auth_user, stream=True)
+    except requests.exceptions.RequestException as e:
+        logging.error(e)
         raise SystemExit(e)
-    return test_json['net']['test']
+    try:
+        if response.status_code > 299:
+            message = "Pulling test metrics from thousand eyes failed with error code " + str(response.status_code) + ": " + url
+            if required:
+                # Like a failed full response this fails the test, so that it is not scheduled as collected
+                logging.warning(message)
+                raise SystemExit(message)
+            logging.debug(message)
+            if response_cache_enabled and response.status_code in negative_statuses:
+                tenant.response_cache.add_negative(url)
+            return
+        response.raw.decode_content = True
+        # The objects of every prefix, and pages.next, are assembled from the parser events of the one response
+        builder = None
+        for prefix, event, value in ijson.parse(response.raw, use_float=True):
+            if builder is None:
+                if prefix not in prefixes:
+                    continue
+                builder = ijson.ObjectBuilder()
+                builder_prefix = prefix
+            builder.event(event, value)
+            if prefix == builder_prefix and event not in ('start_map', 'start_array', 'map_key'):
+                yield builder_prefix, builder.value
+                builder = None
+    finally:
+        response.close()
+
+
+def stream_test_metrics(url, window_params=None):
+    # Returns the test block and the agent metrics of one net/metrics response, the metrics are read while they are iterated
+    # and only the ones that precede the test block in the response are buffered
+    items = stream_te_items(url, ('net.test', 'net.metrics.item'), window_params, required=True)
+    buffered = []
+    for prefix, item in items:
+        if prefix == 'net.test':
+            # Every page repeats the test block, only the one of the first page is kept
+            return item, chain(buffered, (record for record_prefix, record in items if record_prefix != 'net.test'))
+        buffered.append(item)
+    return {}, buffered
+
+
+def get_metric_records(url, section, family, window_params=None, required=False):
+    if not required and response_cache_enabled and current_tenant().response_cache.is_negative(url):
+        # The test had no data for this family recently, the endpoint is asked again once the entry expires
+        count_metric('Response Cache', ('negative',))
+        return []
+    if streaming_enabled:
+        return (item for prefix, item in stream_te_items(url, (section + '.' + family + '.item',), window_params, required))
+    return get_metrics_and_update(url, window_params, required)[section][family]
+
+
+def get_test_metrics(url, window_params=None):
+    # The test block of tests without discovery metadata is read from the same net/metrics response as the metrics
+    if streaming_enabled:
+        return stream_test_metrics(url, window_params)
+    test_json = get_metrics_and_update(url, window_params, required=True)
+    return test_json['net']['test'], test_json['net']['metrics']
+
+
+def get_test_interval(test_id, test_info):
+    # Without the test block the interval recorded by the previous collection of the test is used
+    if test_info is None:
+        tenant = current_tenant()
+        with tenant.schedule_lock:
+            return tenant.schedule.get(str(test_id), {}).get('interval', 0)
+    try:
+        return int(test_info.get('interval', 0))
+    except (TypeError, ValueError):
+        logging.debug("Cannot determine the interval of testid: " + str(test_id))
+        return 0
+
+
+def load_watermarks(tenant):
+    try:
+        with open(tenant.watermark_file) as f:
+            tenant.watermarks.update(json.load(f))
+            logging.debug("Loaded roundId watermarks from " + tenant.watermark_file)
+    except (IOError, OSError, ValueError):
+        logging.debug("No usable roundId watermarks found at " + tenant.watermark_file)
+
+
+def save_watermarks(tenant):
+    temp_file = tenant.watermark_file + ".tmp"
+    try:
+        with tenant.watermarks_lock:
+            with open(temp_file, 'w') as f:
+                json.dump(tenant.watermarks, f, separators=(',', ':'))
+        os.rename(temp_file, tenant.watermark_file)
+    except (IOError, OSError) as e:
+        logging.warning("Failed to persist roundId watermarks to " + tenant.watermark_file)
+        logging.debug(e)
+
+
+def get_test_watermarks(test_id):
+    # A copy taken before publishing, so that rounds published by this collection do not hide
+    # older rounds of a backfill window or further records of the same agent and round
+    tenant = current_tenant()
+    with tenant.watermarks_lock:
+        return dict(tenant.watermarks.get(str(test_id), {}))
+
+
+def update_watermarks(test_id, published_rounds):
+    tenant = current_tenant()
+    with tenant.watermarks_lock:
+        test_watermarks = tenant.watermarks.setdefault(str(test_id), {})
+        for source_id, round_id in published_rounds.items():
+            if round_id > test_watermarks.get(source_id, 0):
+                test_watermarks[source_id] = round_id
+
+
+def get_backfill_params(test_id, interval):
+    # roundId is the epoch second the round started, so the latest watermark tells how long the extension was away
+    tenant = current_tenant()
+    with tenant.watermarks_lock:
+        test_watermarks = tenant.watermarks.get(str(test_id))
+        last_round = max(test_watermarks.values()) if test_watermarks else 0
+    now = int(time.time())
+    if not last_round or not interval or now - last_round <= 2 * interval:
+        return None
+    window_start = max(last_round + 1, now - max_backfill_seconds)
+    logging.info("Backfilling testid: " + str(test_id) + " from " + str(window_start) + " to " + str(now))
+    return {
+        'from': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(window_start)),
+        'to': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(now))
+    }
+
+
+def load_schedule(tenant):
+    try:
+        with open(tenant.schedule_file) as f:
+            tenant.schedule.update(json.load(f))
+            logging.debug("Loaded test schedule from " + tenant.schedule_file)
+    except (IOError, OSError, ValueError):
+        logging.debug("No usable test schedule found at " + tenant.schedule_file)
+
+
+def save_schedule(tenant):
+    temp_file = tenant.schedule_file + ".tmp"
+    try:
+        with tenant.schedule_lock:
+            with open(temp_file, 'w') as f:
+                json.dump(tenant.schedule, f, separators=(',', ':'))
+        os.rename(temp_file, tenant.schedule_file)
+    except (IOError, OSError) as e:
+        logging.warning("Failed to persist the test schedule to " + tenant.schedule_file)
+        logging.debug(e)
+
+
+def update_schedule(test_id, interval, newest_round):
+    # A round becomes available ingestionLag seconds after it started, the next one starts interval seconds later
+    now = time.time()
+    tenant = current_tenant()
+    with tenant.schedule_lock:
+        misses = 0
+        if interval and newest_round:
+            next_poll = newest_round + interval + ingestion_lag
+            if next_poll <= now:
+                # The next round is overdue (test disabled, agents offline, stale test id), the polls back off
+                # from ingestionLag seconds up to one interval instead of repeating on every cycle
+                misses = tenant.schedule.get(str(test_id), {}).get('misses', 0) + 1
+                next_poll = now + min(interval, max(ingestion_lag, 1) * 2 ** min(misses - 1, 16))
+        elif interval:
+            next_poll = now + interval
+        else:
+            next_poll = 0
+        tenant.schedule[str(test_id)] = {'interval': interval, 'nextPoll': int(next_poll)}
+        if misses:
+            tenant.schedule[str(test_id)]['misses'] = misses
+
+
+def get_due_tests(test_ids):
+    # Returns the tests with a new round due, the longest overdue first, tests never polled are always due
+    now = time.time()
+    tenant = current_tenant()
+    with tenant.schedule_lock:
+        next_polls = dict((test_id, tenant.schedule.get(str(test_id), {}).get('nextPoll', 0)) for test_id in test_ids)
+    due = sorted((test_id for test_id in test_ids if next_polls[test_id] <= now), key=lambda test_id: next_polls[test_id])
+    logging.info(str(len(due)) + " of " + str(len(test_ids)) + " tests of tenant " + tenant.name + " have a new round due")
+    return due
 
 
-test_dictionary = {}
 apis = {'net/metrics/', 'net/bgp-metrics/'}
-for test_id in test_ids:
-    logging.info("PullingThousand Eyes data for testid: " + str(test_id))
-    te_api_url = te_api + 'net/metrics/' + str(test_id) + ".json"
-    test_info = get_test_details(te_api_url)
-    test_keys = test_info.keys()
-    try:
-        for test_field in test_keys:
-            if (test_field in schema_dict):
-                test_value = test_info[test_field]
-                if 'date' in test_field:
-                    time_tuple = time.strptime(test_value, '%Y-%m-%d %H:%M:%S')
-                    time_epoch = time.mktime(time_tuple) * 1000
-                    test_dictionary[test_field] = int(time_epoch)
-                elif 'Date' in test_field:
-                    time_tuple = time.strptime(test_value, '%Y-%m-%d %H:%M:%S')
-                    time_epoch = time.mktime(time_tuple) * 1000
-                    test_dictionary[test_field] = int(time_epoch)
-                elif 'apiLinks' in test_field:
-                    test_dictionary[test_field] = test_value[0]['href']
-                else:
-                    test_dictionary[test_field] = test_value
-    except:
-        logging.warning("Failed to collect test metrics")
+agent_join_key = ('agentId', 'roundId')
+# A BGP monitor reports one record per prefix in every round
+bgp_join_key = ('monitorId', 'prefix', 'roundId')
+# net/bgp-metrics is only collected when the schema declares BGP fields, otherwise its events would only repeat the test fields
+bgp_fields = ('monitorId', 'monitorName', 'prefix', 'reachability', 'updates', 'pathChanges')
+
+
+def index_records(records, key_fields):
+    index = {}
+    for record in records:
+        index[tuple(record.get(field) for field in key_fields)] = record
+    return index
+
+
+def join_records(base_records, families, key_fields):
+    # Each family is indexed once so the merge is a single pass over the base records, the source records are not modified
+    indexes = [index_records(records, key_fields) for records in families if records]
+    for record in base_records:
+        key = tuple(record.get(field) for field in key_fields)
+        merged = dict(record)
+        for index in indexes:
+            match = index.get(key)
+            if match is not None:
+                merged.update(match)
+        yield merged
+
+
+def get_record_source(record):
+    # Agent metrics are keyed by agent, bgp-metrics by the BGP monitor that reported them
+    if 'agentId' in record:
+        return record['agentId']
+    return 'monitor-' + str(record.get('monitorId'))
+
+
+def fetch_thousandeyes_tests():
+    tenant = current_tenant()
+    logging.info("Listing thousand eyes tests for discovery of tenant " + tenant.name)
+    tests_url = tenant.te_api + "tests.json"
+    headers = {
+        'accept': 'application/json',
+        'content-type': 'application/json'
+    }
+    te_params = {}
+    if tenant.account_group:
+        te_params.update({'aid': get_thousandeyes_accountid()})
+    response = send_request('GET', tests_url, headers=headers, params=te_params, auth=tenant.te_auth_user)
+    if response.status_code > 299:
+        logging.warning("Listing thousand eyes tests failed with error code " + str(response.status_code))
+        logging.debug("Listing thousand eyes tests failed with response: " + response.text)
+        return None
+    return response.json().get('test', [])
+
+
+def discover_tests():
+    # The listing is cached in memory and under state/tests.json and only refreshed every refreshInterval seconds
+    tenant = current_tenant()
+    discovery_cache = tenant.discovery_cache
+    discovery_cache_file = tenant.discovery_cache_file
+    cache_key = tenant.te_api + "|" + tenant.username + "|" + tenant.account_group
+    if not discovery_cache:
+        try:
+            with open(discovery_cache_file) as f:
+                discovery_cache.update(json.load(f))
+        except (IOError, OSError, ValueError):
+            logging.debug("No usable test discovery cache found at " + discovery_cache_file)
+    cached = discovery_cache.get(cache_key)
+    if cached and time.time() - cached['fetchedAt'] < tenant.discovery_refresh_interval:
+        return cached['tests']
+    try:
+        tests = fetch_thousandeyes_tests()
+    except (requests.exceptions.RequestException, ValueError) as e:
+        logging.warning("Listing thousand eyes tests failed")
+        logging.debug(e)
+        tests = None
+    if tests is None:
+        if cached:
+            logging.warning("Using the test listing cached at " + time.ctime(cached['fetchedAt']))
+            return cached['tests']
+        return []
+    discovery_cache[cache_key] = {'fetchedAt': time.time(), 'tests': tests}
+    temp_file = discovery_cache_file + ".tmp"
+    try:
+        with open(temp_file, 'w') as f:
+            json.dump(discovery_cache, f, separators=(',', ':'))
+        os.rename(temp_file, discovery_cache_file)
+    except (IOError, OSError) as e:
+        logging.warning("Failed to persist the test discovery cache to " + discovery_cache_file)
+        logging.debug(e)
+    return tests
+
+
+def select_test(test):
+    tenant = current_tenant()
+    if tenant.discovery_enabled_only and not test.get('enabled', 1):
+        return False
+    if tenant.discovery_types and test.get('type') not in tenant.discovery_types:
+        return False
+    if tenant.discovery_name_pattern and not tenant.discovery_name_pattern.search(test.get('testName', '')):
+        return False
+    if tenant.discovery_labels:
+        # Labels are returned as test groups in the tests listing
+        test_labels = set(group.get('name') for group in test.get('groups', []))
+        if not test_labels & tenant.discovery_labels:
+            return False
+    return True
+
+
+def get_collection_tests():
+    # Returns the test ids of this cycle and the metadata of the discovered ones, tetestId entries are always collected
+    tenant = current_tenant()
+    test_ids = tenant.test_ids
+    if not tenant.discovery_enabled:
+        return list(test_ids), {}
+    discovered = [test for test in run_timed_phase('Discovery', discover_tests) if select_test(test)]
+    test_metadata = dict((test['testId'], test) for test in discovered)
+    cycle_test_ids = [test['testId'] for test in discovered]
+    cycle_test_ids.extend(test_id for test_id in test_ids if test_id not in test_metadata)
+    logging.info("Discovered " + str(len(discovered)) + " thousand eyes tests of tenant " + tenant.name + " matching the discovery filters")
+    return cycle_test_ids, test_metadata
 
 
+def collect_test(tenant, test_id, test_info=None, priority=None):
+    # Pool threads are reused across tests and tenants, the context is always reset once the test is done
+    request_context.tenant = tenant
+    request_context.priority = priority if priority is not None else tenant.rate_limiter.get_priority(test_id, 0)
+    request_context.deadline = run_deadline
+    try:
+        collect_test_records(test_id, test_info)
+    finally:
+        del request_context.tenant
+        del request_context.priority
+        del request_context.deadline
+
+
+def collect_test_records(test_id, test_info):
+    tenant = current_tenant()
+    plan = tenant.projection_plan
+    te_api = tenant.te_api
+    logging.info("PullingThousand Eyes data for testid: " + str(test_id))
     metric_api_url = te_api + 'net/metrics/'  + str(test_id) + ".json"
     bgp_metrics_api_url= te_api + 'net/bgp-metrics/'  + str(test_id) + ".json"
     page_load_api_url=te_api + 'web/page-load/'  + str(test_id) + ".json"
     http_server_api_url=te_api  + 'web/http-server/'  + str(test_id) + ".json"
 
-    test_metrics = get_metrics_and_update(metric_api_url)['net']
-    test_bgp_metrics={}
-    test_page_load_metrics={}
-    test_http_metrics={}
+    window_params = None
+    if incremental_collection:
+        window_params = get_backfill_params(test_id, get_test_interval(test_id, test_info))
 
-    try:
-        test_bgp_metrics= get_metrics_and_update(bgp_metrics_api_url)['net']['bgpMetrics']
-    except:
-        logging.debug("Test does not contain bgpMetrics metrics or request failed: " + bgp_metrics_api_url)
-        pass
+    # In streaming mode the agent metrics are joined and published while the response is read,
+    # the smaller page-load, http-server and bgp families are collected up front for the join
+    if test_info is None:
+        test_info, test_metric_records = get_test_metrics(metric_api_url, window_params)
+    else:
+        test_metric_records = get_metric_records(metric_api_url, 'net', 'metrics', window_params, required=True)
+    test_dictionary = project_fields(test_info, plan, {})
+    interval = get_test_interval(test_id, test_info)
+    test_bgp_metrics=[]
+    test_page_load_metrics=[]
+    test_http_metrics=[]
+
+    if any(field in tenant.metric_fields for field in bgp_fields):
+        try:
+            test_bgp_metrics= list(get_metric_records(bgp_metrics_api_url, 'net', 'bgpMetrics', window_params))
+        except DeadlineExceeded:
+            raise
+        except:
+            logging.debug("Test does not contain bgpMetrics metrics or request failed: " + bgp_metrics_api_url)
+            pass
 
     try:
-        test_http_metrics= get_metrics_and_update(http_server_api_url)['web']['httpServer']
+        test_http_metrics= list(get_metric_records(http_server_api_url, 'web', 'httpServer', window_params))
+    except DeadlineExceeded:
+        raise
     except:
         logging.debug("Test does not contain httpServer metrics or request failed: "+http_server_api_url)
         pass
     try:
-        test_page_load_metrics=get_metrics_and_update(page_load_api_url)['web']['pageLoad']
+        test_page_load_metrics= list(get_metric_records(page_load_api_url, 'web', 'pageLoad', window_params))
+    except DeadlineExceeded:
+        raise
     except:
-        logging.debug("Test does not contain httpServer metrics or request failed: " + http_server_api_url)
+        logging.debug("Test does not contain pageLoad metrics or request failed: " + page_load_api_url)
         pass
 
 
-    for agent in test_metrics['metrics']:
-        metrics_keys = agent.keys()
-        metric_dictionary = {}
-
-        for pageload in test_page_load_metrics:
-          if (agent['agentId'] == pageload['agentId']):
-            agent.update(pageload)
-            metrics_keys = agent.keys()
-            #metrics_keys= metrics_keys+list(set(pageload.keys()) - set(metrics_keys))
-
-        for httpServer in test_http_metrics:
-          if (agent['agentId'] == httpServer['agentId']):
-            agent.update(httpServer)
-            metrics_keys=agent.keys()
-            #metrics_keys= metrics_keys+list(set(httpServer.keys()) - set(metrics_keys))
-
-        for metric_field in metrics_keys:
-            if (metric_field in schema_dict):
-                metric_value = agent[metric_field]
-                if 'date' in metric_field:
-                    time_tuple = time.strptime(metric_value, '%Y-%m-%d %H:%M:%S')
-                    time_epoch = time.mktime(time_tuple) * 1000
-                    metric_dictionary[metric_field] = int(time_epoch)
-                elif 'createdDate' in metric_field:
-                    time_tuple = time.strptime(metric_value, '%Y-%m-%d %H:%M:%S')
-                    time_epoch = time.mktime(time_tuple) * 1000
-                    metric_dictionary[metric_field] = int(time_epoch)
-                else:
-                    metric_dictionary[metric_field] = metric_value
-            appd_dictionary = {}
-            appd_dictionary.update(test_dictionary)
-            appd_dictionary.update(metric_dictionary)
-            appd_dictionary.update(extension_schema)
-        logging.info("Posting Thousand Eyes data into custom schema for test: " + str(test_id) + " and agent: " + str(metric_dictionary['agentId']))
-        logging.debug("Posting Data in AppDynamics schema: "+str(metric_dictionary))
-        post_appdynamics_data(appd_dictionary)
+    records = chain(join_records(test_metric_records, [test_page_load_metrics, test_http_metrics], agent_join_key),
+                    join_records(test_bgp_metrics, [], bgp_join_key))
+    join_started = time.time()
+    publish_time = 0
+    newest_round = 0
+    test_watermarks = get_test_watermarks(test_id) if incremental_collection else {}
+    published_rounds = {}
+    complete = False
+    try:
+        for agent in records:
+            source_id = str(get_record_source(agent))
+            newest_round = max(newest_round, agent.get('roundId', 0))
+            if incremental_collection and agent.get('roundId', 0) <= test_watermarks.get(source_id, 0):
+                logging.debug("Skipping already published round " + str(agent.get('roundId')) + " for test: " + str(test_id) + " and agent: " + source_id)
+                continue
+            # The test fields are projected once per test, each event is a single copy of them plus the agent fields
+            appd_dictionary = project_fields(agent, plan, dict(test_dictionary))
+            appd_dictionary.update(tenant.extension_schema)
+            logging.info("Posting Thousand Eyes data into custom schema for test: " + str(test_id) + " and agent: " + source_id)
+            logging.debug("Posting Data in AppDynamics schema: "+str(appd_dictionary))
+            post_started = time.time()
+            post_appdynamics_data(appd_dictionary)
+            publish_time += time.time() - post_started
+            if 'roundId' in agent:
+                update_latest_round(test_id, agent['roundId'])
+                published_rounds[source_id] = max(published_rounds.get(source_id, 0), agent['roundId'])
+        complete = True
+    finally:
+        # Also kept when the collection stops half way, the records published so far are not published again.
+        # Only a backfill window that was read to the end moves the watermarks, its later pages hold older
+        # rounds that a watermark would skip, so an interrupted window is asked again as a whole
+        if incremental_collection and (complete or not window_params):
+            update_watermarks(test_id, published_rounds)
+    # Publishing is measured separately, in streaming mode this also includes reading the net/metrics response
+    observe_metric('Phase Time', ('Join',), time.time() - join_started - publish_time)
+    update_schedule(test_id, interval, newest_round)
+
+
+def update_latest_round(test_id, round_id):
+    tenant = current_tenant()
+    with tenant.latest_rounds_lock:
+        if round_id > tenant.latest_rounds.get(str(test_id), 0):
+            tenant.latest_rounds[str(test_id)] = round_id
+
+
+def get_collection_lag(test_ids):
+    # Seconds between now and the newest published round of the test that is furthest behind
+    tenant = current_tenant()
+    now = time.time()
+    lags = []
+    for test_id in test_ids:
+        with tenant.latest_rounds_lock:
+            newest = tenant.latest_rounds.get(str(test_id), 0)
+        with tenant.watermarks_lock:
+            test_watermarks = tenant.watermarks.get(str(test_id))
+            if test_watermarks:
+                newest = max(newest, max(test_watermarks.values()))
+        if newest:
+            lags.append(now - newest)
+    return max(lags) if lags else None
+
+
+def wait_until(start_time):
+    # Sleeps in short steps so that the deadline and a shutdown request end the wait early
+    while True:
+        check_deadline()
+        remaining = start_time - time.time()
+        if remaining <= 0:
+            return
+        time.sleep(min(remaining, 0.5))
+
+
+def collect_all_tests(test_ids, test_metadata=None):
+    tenant = current_tenant()
+    test_metadata = test_metadata or {}
+    started = time.time()
+    completed = []
+    failed = []
+    missed = []
+    # Test starts are spaced evenly over at most half of the remaining time so that the
+    # ThousandEyes API does not receive every test of the cycle at once
+    spacing = 0
+    if spread_seconds and len(test_ids) > 1:
+        spacing = min(spread_seconds, max(0, run_deadline - started) / 2) / len(test_ids)
+    executor = ThreadPoolExecutor(max_workers=collection_workers)
+    futures = {}
+    try:
+        for index, test_id in enumerate(test_ids):
+            wait_until(started + index * spacing)
+            priority = tenant.rate_limiter.get_priority(test_id, index)
+            futures[executor.submit(run_timed_phase, 'Test Collection', collect_test, tenant, test_id, test_metadata.get(test_id), priority)] = test_id
+    except DeadlineExceeded:
+        missed.extend(test_ids[len(futures):])
+    try:
+        for future in as_completed(futures, timeout=max(0, run_deadline - time.time())):
+            test_id = futures[future]
+            try:
+                future.result()
+                completed.append(test_id)
+                logging.debug("Finished collection for testid: " + str(test_id))
+            except DeadlineExceeded:
+                missed.append(test_id)
+            except (Exception, SystemExit) as e:
+                failed.append(test_id)
+                logging.error("Collection failed for testid: " + str(test_id))
+                logging.error(e)
+    except FuturesTimeoutError:
+        for future in futures:
+            if not future.done():
+                future.cancel()
+                missed.append(futures[future])
+    executor.shutdown(wait=False)
+    observe_metric('Phase Time', ('Collection Cycle',), time.time() - started)
+    count_metric('Tests', ('completed',), len(completed))
+    count_metric('Tests', ('failed',), len(failed))
+    count_metric('Tests', ('missed deadline',), len(missed))
+    logging.info("Collection of tenant " + tenant.name + " finished in " + str(round(time.time() - started, 2)) + " seconds: " + str(len(completed))
+                 + " completed, " + str(len(failed)) + " failed, " + str(len(missed)) + " missed the deadline")
+    if missed:
+        logging.warning("Tests of tenant " + tenant.name + " that missed the collection deadline: " + ", ".join(str(test_id) for test_id in missed))
+    return completed, failed, missed
+
+
+class Tenant(object):
+    """A ThousandEyes account group and AppDynamics destination, collected with its own credentials, tests and state."""
+
+    def __init__(self, name, state_directory):
+        self.name = name
+        self.state_directory = state_directory
+        if not os.path.exists(state_directory):
+            os.makedirs(state_directory)
+        self.watermark_file = os.path.join(state_directory, 'watermarks.json')
+        self.watermarks = {}
+        self.watermarks_lock = threading.Lock()
+        self.schedule_file = os.path.join(state_directory, 'schedule.json')
+        self.schedule = {}
+        self.schedule_lock = threading.Lock()
+        self.latest_rounds = {}
+        self.latest_rounds_lock = threading.Lock()
+        self.discovery_cache_file = os.path.join(state_directory, 'tests.json')
+        self.discovery_cache = {}
+        self.schema_state_file = os.path.join(state_directory, 'schema.json')
+        self.response_cache = ResponseCache(os.path.join(state_directory, 'negative_responses.json'))
+        self.publisher = None
+        load_watermarks(self)
+        load_schedule(self)
+
+    def configure(self, tenant_config):
+        te_config = tenant_config['TEConfig']
+        self.username = te_config['teUsername']
+        logging.debug("Setting thousand eyes username of tenant " + self.name + " = " + self.username)
+        self.te_api = te_config['teAPI']
+        logging.debug("Setting thousand eyes API URL of tenant " + self.name + " = " + self.te_api)
+        self.account_group = te_config['teAccountGroup']
+        logging.debug("Setting thousand eyes Account Group of tenant " + self.name + " = " + str(self.account_group))
+        self.te_auth_user = HTTPBasicAuth(self.username, te_config['teKey'])
+        self.account_group_cache_ttl = int(te_config.get('accountGroupCacheTTL', 86400))
+        self.test_ids = te_config.get('tetestId') or []
+        logging.debug("Setting thousand eyes test ids of tenant " + self.name + " = " + str(self.test_ids))
+
+        # The fields of a tenant are the top level Extension, Test and Metrics fields plus the ones declared under the tenant
+        self.schema_dict = {}
+        self.schema_dict.update(tenant_config['Extension'])
+        self.schema_dict.update(tenant_config['Test'])
+        self.schema_dict.update(tenant_config['Metrics'])
+        projection_fields = {}
+        projection_fields.update(tenant_config['Test'])
+        projection_fields.update(tenant_config['Metrics'])
+        self.projection_plan = compile_projection_plan(projection_fields)
+        self.metric_fields = list(tenant_config['Metrics'])
+        logging.debug("Setting schema fields of tenant " + self.name + " = " + str(self.schema_dict))
+
+        self.appd_config = tenant_config['AppDynamics']
+        logging.debug("Setting AppDynamics schema of tenant " + self.name + " = " + self.appd_config['schemaName'])
+        self.schema_revalidation_interval = int(self.appd_config.get('schemaRevalidationInterval', 86400))
+        self.extension_schema = {}
+        if self.account_group is not None:
+            self.extension_schema['AccountGroup'] = self.account_group
+        if self.appd_config.get('hostname') is not None:
+            self.extension_schema['extensionHost'] = self.appd_config['hostname']
+
+        discovery_config = tenant_config['Discovery']
+        self.discovery_enabled = bool(discovery_config.get('enabled', False))
+        self.discovery_refresh_interval = int(discovery_config.get('refreshInterval', 3600))
+        self.discovery_types = set(discovery_config.get('types') or [])
+        self.discovery_name_pattern = re.compile(discovery_config['namePattern']) if discovery_config.get('namePattern') else None
+        self.discovery_labels = set(discovery_config.get('labels') or [])
+        self.discovery_enabled_only = bool(discovery_config.get('enabledOnly', True))
+        logging.debug("Setting test discovery of tenant " + self.name + " = " + str(discovery_config))
+
+        self.rate_limiter = get_rate_limiter(self.te_api, self.username, tenant_config['RateLimit'])
+        spool_directory = os.path.join(self.state_directory, 'spool')
+        if self.publisher is None:
+            self.publisher = EventPublisher(publishing_config, spool_directory, self.appd_config)
+        else:
+            self.publisher.appd_config = self.appd_config
+            self.publisher.configure(publishing_config)
+
+    def save_state(self):
+        if incremental_collection:
+            save_watermarks(self)
+        # Also kept without scheduling, the recorded intervals decide the backfill window of tests without metadata
+        save_schedule(self)
+        if response_cache_enabled:
+            self.response_cache.save_negative_results()
+
+
+tenants = []
+
+
+def configure_tenants():
+    # Tenants are matched by name so that a reload keeps their state, spool and publisher
+    global tenants
+    existing = dict((tenant.name, tenant) for tenant in tenants)
+    configured = []
+    for tenant_config in tenant_configs:
+        tenant = existing.pop(tenant_config['name'], None) or Tenant(tenant_config['name'], tenant_config['stateDirectory'])
+        tenant.configure(tenant_config)
+        configured.append(tenant)
+    tenants = configured
+    for tenant in existing.values():
+        logging.info("Tenant " + tenant.name + " was removed from the configuration")
+        close_tenant(tenant)
+
+
+def close_tenant(tenant):
+    tenant.publisher.close()
+    tenant.save_state()
 
 
+def close_tenants():
+    # Publishers drain in parallel so that stopping does not take drainTimeout once per tenant
+    threads = [threading.Thread(target=close_tenant, args=(tenant,)) for tenant in tenants]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+configure_tenants()
+
+
+def run_tenant_cycle(tenant):
+    # Returns the collection lag of the tenant, errors only end the cycle of the tenant that raised them
+    request_context.tenant = tenant
+    try:
+        run_timed_phase('Schema Sync', sync_appdynamics_schema)
+        cycle_test_ids, test_metadata = get_collection_tests()
+        due_test_ids = cycle_test_ids
+        if scheduling_enabled:
+            due_test_ids = get_due_tests(cycle_test_ids)
+            count_metric('Tests', ('not due',), len(cycle_test_ids) - len(due_test_ids))
+        collect_all_tests(due_test_ids, test_metadata)
+        return get_collection_lag(cycle_test_ids)
+    finally:
+        tenant.publisher.flush()
+        tenant.response_cache.end_cycle()
+        tenant.save_state()
+        del request_context.tenant
+
+
+def run_cycle():
+    global run_deadline
+    # The deadline covers the whole cycle and is cleared afterwards so that it does not leak into the next one
+    run_deadline = time.time() + collection_deadline
+    collection_lags = []
+    try:
+        executor = ThreadPoolExecutor(max_workers=len(tenants))
+        futures = dict((executor.submit(run_tenant_cycle, tenant), tenant) for tenant in tenants)
+        for future in as_completed(futures):
+            try:
+                collection_lag = future.result()
+                if collection_lag is not None:
+                    collection_lags.append(collection_lag)
+            except (Exception, SystemExit) as e:
+                logging.error("Collection cycle failed for tenant " + futures[future].name)
+                logging.error(e)
+        executor.shutdown(wait=False)
+    finally:
+        run_deadline = None
+    if collection_lags:
+        set_gauge_metric('Collection Lag Seconds', (), int(max(collection_lags)))
+
+
+def report_cycle_metrics():
+    print_machine_agent_metrics()
+    cycle_metrics.reset()
+
+
+def close_sessions():
+    with sessions_lock:
+        for session in sessions.values():
+            session.close()
+        sessions.clear()
+
+
+def reload_config_if_changed():
+    try:
+        if os.path.getmtime(config_file) == config_mtime:
+            return
+    except OSError as e:
+        logging.warning("Cannot access configuration file " + config_file + ", keeping the current configuration")
+        logging.debug(e)
+        return
+    logging.info("Configuration file " + config_file + " changed, reloading")
+    previous_transport = (certificate_bundle, pool_size, max_retries, backoff_factor)
+    previous_concurrency = per_host_concurrency
+    try:
+        load_config()
+    except Exception as err:
+        logging.error("Failed to reload " + config_file + ", keeping the current configuration")
+        logging.error(err)
+        return
+    if (certificate_bundle, pool_size, max_retries, backoff_factor) != previous_transport:
+        logging.info("Transport settings changed, recreating pooled sessions")
+        close_sessions()
+    if per_host_concurrency != previous_concurrency:
+        with host_semaphores_lock:
+            host_semaphores.clear()
+    # The schema is checked again at the start of the next cycle when the fingerprint changed
+    configure_tenants()
+
+
+shutdown_requested = threading.Event()
+
+
+def handle_shutdown(signum, frame):
+    global run_deadline
+    logging.info("Received signal " + str(signum) + ", shutting down after the current cycle")
+    shutdown_requested.set()
+    # Make in-flight collection stop at its next request instead of waiting for the full deadline
+    run_deadline = time.time()
+
+
+def run_daemon():
+    signal.signal(signal.SIGTERM, handle_shutdown)
+    signal.signal(signal.SIGINT, handle_shutdown)
+    logging.info("Starting collection cycles every " + str(daemon_interval) + " seconds")
+    if prometheus_port:
+        start_prometheus_endpoint()
+    while not shutdown_requested.is_set():
+        cycle_started = time.time()
+        try:
+            run_cycle()
+        except (Exception, SystemExit) as e:
+            logging.error("Collection cycle failed")
+            logging.error(e)
+        # Batches published in the background since the previous cycle are included in this report
+        report_cycle_metrics()
+        shutdown_requested.wait(max(0, daemon_interval - (time.time() - cycle_started)))
+        if not shutdown_requested.is_set():
+            reload_config_if_changed()
+    close_tenants()
+    close_sessions()
+    logging.info("AppDynamics & Thousand Eyes Extension stopped")
+
 
+if daemon_mode:
+    run_daemon()
+else:
+    # The spool is drained by close_tenants, so the metrics are printed afterwards to include the publishing
+    run_cycle()
+    close_tenants()
+    report_cycle_metrics()
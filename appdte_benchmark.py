@@ -0,0 +1,554 @@
+# coding: utf8
+# **********************************************************************
+# Script Name:      appdte_benchmark.py
+# Purpose:          Benchmark for the AppDynamics & ThousandEyes extension. Starts local stand-ins for the
+#                   ThousandEyes API and the AppDynamics Events Service, runs appdte.py end to end against
+#                   them and reports wall time, requests per upstream, events/s and peak RSS
+# Prerequisites:    python3, the same packages as appdte.py
+#
+# THE SCRIPT IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THIS SCRIPT OR THE USE OR OTHER DEALINGS IN THE SCRIPT.
+# **********************************************************************
+import getopt
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import yaml
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+account_group_name = "Benchmark"
+schema_name = "TEBenchmark"
+# Added to Metrics with --bgp, net/bgp-metrics is only collected when the schema declares them
+bgp_fields = {
+    'monitorId': 'integer',
+    'monitorName': 'string',
+    'prefix': 'string',
+    'reachability': 'float',
+    'updates': 'integer',
+    'pathChanges': 'integer'
+}
+
+
+class MockState(object):
+    """Request counters and received events shared by the mock upstreams."""
+
+    def __init__(self, tests, agents, monitors, latency, rate_limit=0, rounds=1, records=1, bgp=False, page_size=0):
+        self.tests = tests
+        self.agents = agents
+        self.monitors = monitors
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.rounds = rounds
+        self.records = records
+        self.bgp = bgp
+        self.page_size = page_size
+        self.window_start = 0
+        self.window_requests = 0
+        self.round_id = int(time.time()) // 60 * 60 - 60
+        self.lock = threading.Lock()
+        self.requests = Counter()
+        self.events = 0
+        self.bytes_received = 0
+        self.bytes_decoded = 0
+        self.bytes_legacy = 0
+        self.schemas = {}
+
+    def count(self, upstream, endpoint):
+        with self.lock:
+            self.requests[upstream + " " + endpoint] += 1
+
+    def take_quota(self):
+        # Per minute organization quota of the ThousandEyes stand-in, returns the rate limit headers
+        # and whether the request is within the quota
+        with self.lock:
+            now = time.time()
+            if now - self.window_start >= 60:
+                self.window_start = now
+                self.window_requests = 0
+            self.window_requests += 1
+            reset = int(self.window_start + 60)
+            headers = {
+                'X-Organization-Rate-Limit-Limit': str(self.rate_limit),
+                'X-Organization-Rate-Limit-Remaining': str(max(0, self.rate_limit - self.window_requests)),
+                'X-Organization-Rate-Limit-Reset': str(reset)
+            }
+            if self.window_requests <= self.rate_limit:
+                return headers, True
+            headers['Retry-After'] = str(max(1, int(reset - now)))
+            return headers, False
+
+
+def round_date(round_id):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(round_id))
+
+
+def test_type(test_id):
+    # Every other test is a page-load test, web/page-load has no data for the others
+    return 'page-load' if test_id % 2 else 'http-server'
+
+
+def test_block(state, test_id):
+    return {
+        'testId': test_id,
+        'testName': 'Benchmark test ' + str(test_id),
+        'type': test_type(test_id),
+        'interval': 60,
+        'enabled': 1,
+        'protocol': 'TCP',
+        'createdBy': 'Benchmark',
+        'createdDate': '2020-12-13 10:00:00',
+        'apiLinks': [{'rel': 'self', 'href': 'https://api.thousandeyes.com/v6/tests/' + str(test_id)}],
+        'groups': [{'groupId': 1, 'name': 'Benchmark', 'type': 'tests'}]
+    }
+
+
+def round_ids(state):
+    # Like a from/to window of the ThousandEyes API the newest round comes first
+    return [state.round_id - index * 60 for index in range(state.rounds)]
+
+
+def agent_records(state, test_id, fields, records_per_agent=1):
+    records = []
+    for round_id in round_ids(state):
+        for agent_id in range(1, state.agents + 1):
+            for server in range(records_per_agent):
+                record = {'agentId': agent_id, 'roundId': round_id, 'date': round_date(round_id),
+                          'permalink': 'https://app.thousandeyes.com/view/tests/?roundId=' + str(round_id)}
+                record.update(fields(agent_id, server))
+                records.append(record)
+    return records
+
+
+def net_metrics(state, test_id):
+    # With more than one record per agent every record is a different server of the same round
+    return {'net': {'test': test_block(state, test_id), 'metrics': agent_records(state, test_id, lambda agent_id, server: {
+        'agentName': 'Agent ' + str(agent_id),
+        'countryId': 'GB',
+        'serverIp': '10.0.' + str(server) + '.' + str(agent_id % 250),
+        'avgLatency': 10.5 + agent_id % 7,
+        'minLatency': 9.1,
+        'maxLatency': 14.2 + agent_id % 5,
+        'jitter': 0.4,
+        'loss': 0.0
+    }, state.records)}}
+
+
+def page_load(state, test_id):
+    return {'web': {'test': test_block(state, test_id), 'pageLoad': agent_records(state, test_id, lambda agent_id, server: {
+        'pageLoadTime': 800 + agent_id,
+        'domLoadTime': 500 + agent_id,
+        'numObjects': 42
+    })}}
+
+
+def http_server(state, test_id):
+    return {'web': {'test': test_block(state, test_id), 'httpServer': agent_records(state, test_id, lambda agent_id, server: {
+        'responseCode': 200,
+        'responseTime': 120 + agent_id,
+        'totalTime': 180 + agent_id,
+        'wireSize': 15000
+    })}}
+
+
+def bgp_metrics(state, test_id):
+    # Every monitor reports one record per prefix
+    records = []
+    for round_id in round_ids(state):
+        for monitor_id in range(1, state.monitors + 1):
+            for prefix in range(state.records):
+                records.append({'monitorId': monitor_id, 'monitorName': 'Monitor ' + str(monitor_id), 'roundId': round_id,
+                                'date': round_date(round_id), 'prefix': '10.' + str(prefix) + '.0.0/24', 'reachability': 100.0,
+                                'updates': 0, 'pathChanges': 0})
+    return {'net': {'test': test_block(state, test_id), 'bgpMetrics': records}}
+
+
+def paginate(body, page, page_size, link):
+    # Like the ThousandEyes API a response holds page_size records and pages.next links the following page
+    more = False
+    for section in body.values():
+        for family, records in section.items():
+            if isinstance(records, list):
+                section[family] = records[(page - 1) * page_size:page * page_size]
+                more = more or len(records) > page * page_size
+    body['pages'] = {'current': page}
+    if more:
+        body['pages']['next'] = link + '?page=' + str(page + 1)
+    return body
+
+
+def tests_listing(state):
+    return {'test': [test_block(state, test_id) for test_id in range(1, state.tests + 1)]}
+
+
+def make_handler(state, upstream):
+    te_endpoints = {
+        'net/metrics': net_metrics,
+        'web/page-load': page_load,
+        'web/http-server': http_server,
+        'net/bgp-metrics': bgp_metrics
+    }
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def send_json(self, status, body, headers=None):
+            payload = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def read_body(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            with state.lock:
+                state.bytes_received += len(body)
+            if self.headers.get('Content-Encoding') == 'gzip':
+                body = zlib.decompress(body, 31)
+            return body
+
+        def do_GET(self):
+            if state.latency:
+                time.sleep(state.latency)
+            path = self.path.split('?')[0].strip('/')
+            if upstream == 'appdynamics':
+                state.count(upstream, 'GET events/schema')
+                schema = state.schemas.get(path.rpartition('/')[2])
+                if schema is None:
+                    return self.send_json(404, {})
+                return self.send_json(200, {'schema': schema})
+            headers = None
+            if state.rate_limit:
+                headers, allowed = state.take_quota()
+                if not allowed:
+                    state.count(upstream, '429')
+                    return self.send_json(429, {'errorMessage': 'Too many requests'}, headers)
+            if path.endswith('account-groups'):
+                state.count(upstream, 'account-groups')
+                return self.send_json(200, {'accountGroups': [{'accountGroupName': account_group_name, 'aid': 1234}]},
+                                      headers)
+            if path.endswith('tests.json'):
+                state.count(upstream, 'tests')
+                return self.send_json(200, tests_listing(state), headers)
+            endpoint, _, test_file = path.rpartition('/')
+            endpoint = endpoint.split('v6/')[-1]
+            state.count(upstream, endpoint)
+            try:
+                test_id = int(test_file.split('.')[0])
+            except ValueError:
+                return self.send_json(404, {'errorMessage': 'Not found'}, headers)
+            if endpoint not in te_endpoints or test_id > state.tests:
+                return self.send_json(404, {'errorMessage': 'Not found'}, headers)
+            if endpoint == 'web/page-load' and test_type(test_id) != 'page-load':
+                return self.send_json(404, {'errorMessage': 'Not a page-load test'}, headers)
+            page = int(parse_qs(self.path.partition('?')[2]).get('page', ['1'])[0])
+            # The data only changes with a new round, so the round and page identify the response
+            etag = '"' + endpoint.replace('/', '-') + '-' + str(test_id) + '-' + str(state.round_id) + '-' + str(page) + '"'
+            headers = dict(headers or {}, ETag=etag)
+            if self.headers.get('If-None-Match') == etag:
+                state.count(upstream, endpoint + ' 304')
+                self.send_response(304)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                return
+            body = te_endpoints[endpoint](state, test_id)
+            if state.page_size:
+                body = paginate(body, page, state.page_size, 'http://' + self.headers['Host'] + '/' + path)
+            self.send_json(200, body, headers)
+
+        def do_POST(self):
+            if state.latency:
+                time.sleep(state.latency)
+            body = self.read_body()
+            if '/events/publish/' in self.path:
+                state.count(upstream, 'POST events/publish')
+                events = json.loads(body.decode('utf-8'))
+                # Size of the same batch as json.dumps with default separators encoded it before, for the bytes per event comparison
+                legacy_bytes = 2 + len(events) - 1 + sum(len(json.dumps(event)) for event in events)
+                with state.lock:
+                    state.events += len(events)
+                    state.bytes_decoded += len(body)
+                    state.bytes_legacy += legacy_bytes
+                return self.send_json(200, {})
+            state.count(upstream, 'POST events/schema')
+            with state.lock:
+                state.schemas[self.path.strip('/').rpartition('/')[2]] = json.loads(body.decode('utf-8')).get('schema', {})
+            self.send_json(201, {})
+
+        def do_PATCH(self):
+            body = self.read_body()
+            state.count(upstream, 'PATCH events/schema')
+            for operation in json.loads(body.decode('utf-8')):
+                with state.lock:
+                    state.schemas.setdefault(self.path.strip('/').rpartition('/')[2], {}).update(operation.get('add', {}))
+            self.send_json(200, {})
+
+    return Handler
+
+
+def start_server(state, upstream):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(state, upstream))
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name="mock-" + upstream)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def write_config(template, work_dir, state, te_server, appd_server, tenants=0):
+    with open(template) as f:
+        config = yaml.safe_load(f)
+    extension = config['ThousandEyes']
+    extension['TEConfig'].update({
+        'teAPI': 'http://127.0.0.1:' + str(te_server.server_address[1]) + '/v6/',
+        'tetestId': list(range(1, state.tests + 1)),
+        'teUsername': 'benchmark@example.com',
+        'teKey': 'benchmark',
+        'teAccountGroup': account_group_name
+    })
+    extension['AppDynamics'].update({
+        'appdEventsService': 'http://127.0.0.1:' + str(appd_server.server_address[1]),
+        'analyticsApiKey': 'benchmark',
+        'globalAccountName': 'benchmark',
+        'schemaName': schema_name,
+        'hostname': 'benchmark'
+    })
+    extension['TLSCertificate'] = {'certificateBundlePath': ''}
+    if state.bgp:
+        extension['Metrics'].update(bgp_fields)
+    # Every tenant collects the same tests with its own credentials, and therefore its own rate limiter, into its own schema
+    extension['Tenants'] = [{'name': 'tenant-' + str(tenant), 'TEConfig': {'teUsername': 'benchmark' + str(tenant) + '@example.com'},
+                             'AppDynamics': {'schemaName': schema_name + str(tenant)}}
+                            for tenant in range(1, tenants + 1)]
+    # The benchmark measures throughput, so the due tests of the run are started without spreading them and
+    # the request rate is only limited by the quota the ThousandEyes stand-in reports with --rate-limit
+    extension.setdefault('Scheduling', {})['spreadSeconds'] = 0
+    extension.setdefault('RateLimit', {})['requestsPerMinute'] = 1000000
+    schema = {}
+    schema.update(extension['Extension'])
+    schema.update(extension['Test'])
+    schema.update(extension['Metrics'])
+    # The schemas exist already, so that the run does not include creating them
+    for name in [schema_name] + [tenant['AppDynamics']['schemaName'] for tenant in extension['Tenants']]:
+        state.schemas[name] = dict(schema)
+    config_file = os.path.join(work_dir, 'te_appd.yml')
+    with open(config_file, 'w') as f:
+        yaml.safe_dump(config, f, default_flow_style=False)
+    return config_file
+
+
+def get_expected_events(state, tenants):
+    # Every record of every round is published once, by every tenant
+    records = state.agents * state.records * state.rounds
+    if state.bgp:
+        records += state.monitors * state.records * state.rounds
+    return state.tests * records * max(tenants, 1)
+
+
+def run_extension(template, tests, agents, monitors, latency, keep, rate_limit=0, tenants=0, rounds=1, records=1, bgp=False,
+                  page_size=0):
+    state = MockState(tests, agents, monitors, latency, rate_limit, rounds, records, bgp, page_size)
+    te_server = start_server(state, 'thousandeyes')
+    appd_server = start_server(state, 'appdynamics')
+    work_dir = tempfile.mkdtemp(prefix='appdte-benchmark-')
+    try:
+        config_file = write_config(template, work_dir, state, te_server, appd_server, tenants)
+        started = time.time()
+        # The Machine Agent custom metrics printed by the extension are not part of the report
+        with open(os.devnull, 'w') as devnull:
+            result = subprocess.call([sys.executable, os.path.join(script_dir, 'appdte.py'), '-c', config_file],
+                                     cwd=work_dir, stdout=devnull)
+        wall_time = time.time() - started
+    finally:
+        te_server.shutdown()
+        appd_server.shutdown()
+        if keep:
+            print("Kept benchmark directory " + work_dir)
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return {
+        'tests': tests,
+        'agents': agents,
+        'latency': latency,
+        'rateLimit': rate_limit,
+        'tenants': tenants,
+        'rounds': rounds,
+        'records': records,
+        'bgp': bgp,
+        'pageSize': page_size,
+        'exitCode': result,
+        'wallTime': round(wall_time, 3),
+        'requests': dict(state.requests),
+        'thousandeyesRequests': sum(count for name, count in state.requests.items() if name.startswith('thousandeyes')),
+        'appdynamicsRequests': sum(count for name, count in state.requests.items() if name.startswith('appdynamics')),
+        'events': state.events,
+        'expectedEvents': get_expected_events(state, tenants),
+        'eventsPerSecond': round(state.events / wall_time, 1) if wall_time else 0,
+        'bytesReceived': state.bytes_received,
+        'bytesPerEvent': round(state.bytes_received / float(state.events), 1) if state.events else 0,
+        'jsonBytesPerEvent': round(state.bytes_decoded / float(state.events), 1) if state.events else 0,
+        'legacyBytesPerEvent': round(state.bytes_legacy / float(state.events), 1) if state.events else 0,
+        # ru_maxrss of the children is the peak of the largest finished child, in kilobytes on Linux
+        'peakRssMB': round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.0, 1)
+    }
+
+
+def print_report(report):
+    print("Tests: " + str(report['tests']) + "  Agents per test: " + str(report['agents'])
+          + "  Injected latency: " + str(report['latency']) + "s"
+          + ("  Tenants: " + str(report['tenants']) if report.get('tenants') else "")
+          + ("  Rounds: " + str(report['rounds']) if report.get('rounds', 1) > 1 else "")
+          + ("  Records per agent: " + str(report['records']) if report.get('records', 1) > 1 else ""))
+    print("  Exit code:               " + str(report['exitCode']))
+    print("  Wall time:               " + str(report['wallTime']) + " s")
+    print("  ThousandEyes requests:   " + str(report['thousandeyesRequests']))
+    print("  AppDynamics requests:    " + str(report['appdynamicsRequests']))
+    for name in sorted(report['requests']):
+        print("      " + name.ljust(38) + str(report['requests'][name]))
+    print("  Events published:        " + str(report['events']) + " of " + str(report['expectedEvents']) + " expected")
+    print("  Events/s:                " + str(report['eventsPerSecond']))
+    print("  Bytes to Events Service: " + str(report['bytesReceived']))
+    print("  Bytes per event:         " + str(report['bytesPerEvent']) + " sent, " + str(report['jsonBytesPerEvent'])
+          + " uncompressed, " + str(report['legacyBytesPerEvent']) + " with default json.dumps encoding")
+    print("  Peak RSS:                " + str(report['peakRssMB']) + " MB")
+
+
+def compare_reports(report, baseline, tolerance):
+    regressions = []
+    for metric in ('wallTime', 'thousandeyesRequests', 'appdynamicsRequests', 'peakRssMB', 'bytesPerEvent'):
+        if metric in baseline and baseline[metric] and report[metric] > baseline[metric] * (1 + tolerance / 100.0):
+            regressions.append(metric + " " + str(baseline[metric]) + " -> " + str(report[metric]))
+    if baseline.get('events') and report['events'] < baseline['events']:
+        regressions.append("events " + str(baseline['events']) + " -> " + str(report['events']))
+    return regressions
+
+
+def usage():
+    print("AppDynamics & ThousandEyes extension benchmark")
+    print("")
+    print("options:")
+    print("-h,  --help                show brief help")
+    print("-t,  --tests               number of ThousandEyes tests, default 50")
+    print("-a,  --agents              number of agents per test, default 20")
+    print("     --monitors            number of BGP monitors per test, default 5")
+    print("-l,  --latency             latency in seconds injected in every mock response, default 0.05")
+    print("     --rate-limit          ThousandEyes requests per minute allowed by the mock before it answers 429, default 0 (no limit)")
+    print("     --tenants             collect the tests as this many tenants of one process, default 0 (single tenant configuration)")
+    print("     --bgp                 add the BGP fields to Metrics so that the bgp-metrics records are published")
+    print("     --rounds              rounds per metrics response, newest first, default 1")
+    print("     --records             records per agent (servers) and per BGP monitor (prefixes) in each round, default 1")
+    print("     --page-size           records per page of the metrics responses, linked with pages.next, default 0 (one page)")
+    print("-c,  --config              te_appd.yml used as template for the extension settings, default te_appd.yml")
+    print("     --save                write the report as json to the given file")
+    print("     --compare             compare against a report saved with --save, exits with 1 on regression")
+    print("     --tolerance           allowed regression in percent for --compare, default 20")
+    print("     --keep                keep the working directory with the extension logs")
+
+
+def main(argument_list):
+    tests = 50
+    agents = 20
+    monitors = 5
+    latency = 0.05
+    template = os.path.join(script_dir, 'te_appd.yml')
+    save_file = None
+    compare_file = None
+    tolerance = 20.0
+    keep = False
+    rate_limit = 0
+    tenants = 0
+    rounds = 1
+    records = 1
+    bgp = False
+    page_size = 0
+    try:
+        arguments, values = getopt.getopt(argument_list, "ht:a:l:c:", ["help", "tests=", "agents=", "monitors=", "latency=",
+                                                                      "config=", "save=", "compare=", "tolerance=", "keep",
+                                                                      "rate-limit=", "tenants=", "rounds=", "records=", "bgp",
+                                                                      "page-size="])
+    except getopt.error as err:
+        print(str(err))
+        usage()
+        return 2
+    for current_argument, current_value in arguments:
+        if current_argument in ("-h", "--help"):
+            usage()
+            return 0
+        elif current_argument in ("-t", "--tests"):
+            tests = int(current_value)
+        elif current_argument in ("-a", "--agents"):
+            agents = int(current_value)
+        elif current_argument == "--monitors":
+            monitors = int(current_value)
+        elif current_argument in ("-l", "--latency"):
+            latency = float(current_value)
+        elif current_argument in ("-c", "--config"):
+            template = current_value
+        elif current_argument == "--save":
+            save_file = current_value
+        elif current_argument == "--compare":
+            compare_file = current_value
+        elif current_argument == "--tolerance":
+            tolerance = float(current_value)
+        elif current_argument == "--keep":
+            keep = True
+        elif current_argument == "--rate-limit":
+            rate_limit = int(current_value)
+        elif current_argument == "--tenants":
+            tenants = int(current_value)
+        elif current_argument == "--rounds":
+            rounds = int(current_value)
+        elif current_argument == "--records":
+            records = int(current_value)
+        elif current_argument == "--bgp":
+            bgp = True
+        elif current_argument == "--page-size":
+            page_size = int(current_value)
+
+    report = run_extension(template, tests, agents, monitors, latency, keep, rate_limit, tenants, rounds, records, bgp,
+                           page_size)
+    print_report(report)
+    if save_file:
+        with open(save_file, 'w') as f:
+            json.dump(report, f, indent=2)
+    if report['exitCode'] != 0:
+        return 1
+    if report['events'] != report['expectedEvents']:
+        print("Published " + str(report['events']) + " events, expected " + str(report['expectedEvents']))
+        return 1
+    if compare_file:
+        with open(compare_file) as f:
+            baseline = json.load(f)
+        regressions = compare_reports(report, baseline, tolerance)
+        if regressions:
+            print("Regressions against " + compare_file + ":")
+            for regression in regressions:
+                print("  " + regression)
+            return 1
+        print("No regressions against " + compare_file)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))